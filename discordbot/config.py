@@ -24,4 +24,13 @@ config = {
     "bot-http-listen-interfaces": env.get(
         "TITAN_BOT_HTTP_LISTEN_INTERFACES", "127.0.0.1"
     ),
+    # serve channel messages from redis once a channel has been read from
+    # discord, relying on gateway events to keep it up to date. The webapp
+    # reads the same variable.
+    "message-cache-authoritative": env.get(
+        "TITAN_BOT_MESSAGE_CACHE_AUTHORITATIVE", "true"
+    ).lower()
+    in ("1", "true", "yes"),
+    # number of most recent messages kept in redis per channel
+    "message-cache-size": int(env.get("TITAN_BOT_MESSAGE_CACHE_SIZE", 100)),
 }
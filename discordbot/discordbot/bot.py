@@ -1,4 +1,5 @@
 import sys
+import time
 import asyncio
 import logging
 from collections import deque
@@ -13,7 +14,7 @@ from redis.exceptions import ConnectionError
 from discordbot import commands, redis_cache
 from discordbot.poststats import BotsDiscordPw, DiscordBotsOrg
 from discordbot.socketio import SocketIOInterface
-from discordbot.utils import guild_webhooks
+from discordbot.utils import guild_webhooks, single_flight
 
 # try:
 #     raven_client = RavenClient(config["sentry-dsn"])
@@ -24,6 +25,12 @@ intents = discord.Intents.default()
 intents.message_content = True
 
 DEFAULT_CHANNEL_MESSAGES_LIMIT = 50
+# seconds without further events before a guild's cached snapshot is rebuilt
+GUILD_UPDATE_DEBOUNCE = 1
+# longest a rebuild is put off by a continuous stream of events
+GUILD_UPDATE_MAX_DELAY = 5
+# seconds that a guild's webhooks are reused before asking discord again
+WEBHOOKS_CACHE_TTL = 60 * 5
 
 
 def setup_logger(shard_ids=None):
@@ -78,12 +85,24 @@ class Titan(discord.AutoShardedClient):
 
         self.post_stats_task = None
 
+        # guild id -> (pending rebuild task, time the first event came in)
+        self.guild_update_tasks = {}
+        # guild id -> (webhooks, time they were fetched)
+        self.webhooks_cache = {}
+        # guilds whose emojis changed since their snapshot was last rebuilt
+        self.emojis_updated = set()
+
     async def start(self, token: str, *, reconnect: bool = True) -> None:
         self.log.info("init redis")
         await redis_cache.init_redis(config["redis-uri"])
         self.log.info("connecting to discord")
         await super().start(config["bot-token"], reconnect=reconnect)
 
+    async def close(self):
+        await super().close()
+        # cached writes are batched for a moment, send them before exiting
+        await redis_cache.writer.drain()
+
     async def on_shard_ready(self, shard_id):
         self.log.info("Titan [DiscordBot]")
         self.log.info("Logged in as the following user:")
@@ -94,6 +113,18 @@ class Titan(discord.AutoShardedClient):
         self.log.info("Shard id: " + str(shard_id))
         self.log.info("------")
 
+        # A new gateway session means message events may have been missed
+        # (or the bot has just started), so drop the cached channel messages
+        # of this shard and let them be read from discord again.
+        await redis_cache.delete_channels_messages(
+            [
+                channel
+                for guild in self.guilds
+                if guild.shard_id == shard_id
+                for channel in guild.text_channels
+            ]
+        )
+
         if config["discord-bots-org-token"]:
             self.discordBotsOrg = DiscordBotsOrg(
                 self.user.id, config["discord-bots-org-token"]
@@ -159,69 +190,96 @@ class Titan(discord.AutoShardedClient):
         await self.socketio.on_reaction_clear(message)
 
     async def on_guild_join(self, guild):
-        await redis_cache.update_guild(
-            guild, server_webhooks=(await guild_webhooks(guild))
-        )
+        self.schedule_guild_update(guild)
         await self.postStats()
 
     async def on_guild_remove(self, guild):
+        if pending := self.guild_update_tasks.pop(guild.id, None):
+            pending[0].cancel()
+        self.webhooks_cache.pop(guild.id, None)
+        self.emojis_updated.discard(guild.id)
         await redis_cache.delete_guild(guild)
         await self.postStats()
 
     async def on_guild_update(self, guildbefore, guildafter):
-        # TODO
-        await redis_cache.update_guild(
-            guildafter.guild,
-            server_webhooks=(await guild_webhooks(guildafter.guild)),
-        )
+        self.schedule_guild_update(guildafter)
         await self.socketio.on_guild_update(guildafter)
 
     async def on_guild_role_create(self, role):
         if role.name == self.user.name and role.managed:
             await asyncio.sleep(2)
-        await redis_cache.update_guild(
-            role.guild, server_webhooks=(await guild_webhooks(role.guild))
-        )
+        self.schedule_guild_update(role.guild)
         await self.socketio.on_guild_role_create(role)
 
     async def on_guild_role_delete(self, role):
         if role.guild.me not in role.guild.members:
             return
-        await redis_cache.update_guild(
-            role.guild, server_webhooks=(await guild_webhooks(role.guild))
-        )
+        self.schedule_guild_update(role.guild)
         await self.socketio.on_guild_role_delete(role)
 
     async def on_guild_role_update(self, rolebefore, roleafter):
-        await redis_cache.update_guild(
-            roleafter.guild,
-            server_webhooks=(await guild_webhooks(roleafter.guild)),
-        )
+        me = roleafter.guild.me
+        if me and roleafter in me.roles:
+            # our permissions may have changed, and with them our access to
+            # the guild's webhooks
+            self.webhooks_cache.pop(roleafter.guild.id, None)
+        self.schedule_guild_update(roleafter.guild)
         await self.socketio.on_guild_role_update(roleafter)
 
     async def on_guild_channel_delete(self, channel):
         if channel.guild:
-            await redis_cache.update_guild(
-                channel.guild,
-                server_webhooks=(await guild_webhooks(channel.guild)),
-            )
+            self.schedule_guild_update(channel.guild)
             await self.socketio.on_channel_delete(channel)
 
     async def on_guild_channel_create(self, channel):
         if channel.guild:
-            await redis_cache.update_guild(
-                channel.guild,
-                server_webhooks=(await guild_webhooks(channel.guild)),
-            )
+            self.schedule_guild_update(channel.guild)
             await self.socketio.on_channel_create(channel)
 
     async def on_guild_channel_update(self, channelbefore, channelafter):
-        await redis_cache.update_guild(
-            channelafter.guild,
-            server_webhooks=(await guild_webhooks(channelafter.guild)),
-        )
+        self.schedule_guild_update(channelafter.guild)
         await self.socketio.on_channel_update(channelafter)
 
+    def schedule_guild_update(self, guild):
+        # rebuild the guild snapshot once its events have been quiet for
+        # GUILD_UPDATE_DEBOUNCE seconds, so a burst of role or channel events
+        # costs one rebuild
+        now = time.monotonic()
+        first_event = now
+        if pending := self.guild_update_tasks.get(guild.id):
+            task, first_event = pending
+            if now - first_event > GUILD_UPDATE_MAX_DELAY:
+                return
+            task.cancel()
+
+        task = self.loop.create_task(self.update_guild_later(guild.id))
+        task.add_done_callback(_handle_task_result)
+        self.guild_update_tasks[guild.id] = (task, first_event)
+
+    async def update_guild_later(self, guild_id):
+        await asyncio.sleep(GUILD_UPDATE_DEBOUNCE)
+        self.guild_update_tasks.pop(guild_id, None)
+
+        if guild := self.get_guild(guild_id):
+            await redis_cache.update_guild(
+                guild, server_webhooks=(await self.get_guild_webhooks(guild))
+            )
+            # the webapp reloads its emojis from the snapshot just written
+            if guild_id in self.emojis_updated:
+                self.emojis_updated.discard(guild_id)
+                await redis_cache.invalidate_guild_emojis(guild)
+
+    async def get_guild_webhooks(self, guild):
+        cached = self.webhooks_cache.get(guild.id)
+        if cached and time.monotonic() - cached[1] < WEBHOOKS_CACHE_TTL:
+            return cached[0]
+
+        webhooks = await single_flight(
+            ("webhooks", guild.id), guild_webhooks, guild
+        )
+        self.webhooks_cache[guild.id] = (webhooks, time.monotonic())
+        return webhooks
+
     async def on_member_join(self, member):
         await redis_cache.add_member(member)
         await redis_cache.add_member_to_guild(member.guild, member)
@@ -232,6 +290,9 @@ class Titan(discord.AutoShardedClient):
         await self.socketio.on_guild_member_remove(member)
 
     async def on_member_update(self, memberbefore, memberafter):
+        if memberafter.id == self.user.id:
+            self.webhooks_cache.pop(memberafter.guild.id, None)
+            self.schedule_guild_update(memberafter.guild)
         await redis_cache.update_member(memberafter)
         await self.socketio.on_guild_member_update(memberafter)
 
@@ -241,17 +302,15 @@ class Titan(discord.AutoShardedClient):
         await redis_cache.ban_member(guild, user)
 
     async def on_guild_emojis_update(self, guild, before, after):
-        await redis_cache.update_guild(
-            guild, server_webhooks=(await guild_webhooks(guild))
-        )
+        self.emojis_updated.add(guild.id)
+        self.schedule_guild_update(guild)
         await self.socketio.on_guild_emojis_update(
             after if len(after) else before
         )
 
-    # async def on_webhooks_update(self, channel):
-    #     await redis_cache.update_guild(channel.guild)
-    #     await redis_cache.update_guild(channel.guild,
-    #       server_webhooks=(await guild_webhooks(channel.guild)))
+    async def on_webhooks_update(self, channel):
+        self.webhooks_cache.pop(channel.guild.id, None)
+        self.schedule_guild_update(channel.guild)
 
     async def on_raw_message_edit(self, payload):
         message_id = payload.message_id
@@ -364,9 +423,8 @@ class Titan(discord.AutoShardedClient):
         guild_id = int(msg["d"]["guild_id"])
         guild = self.get_guild(guild_id)
         if guild:
-            await redis_cache.update_guild(
-                guild, server_webhooks=(await guild_webhooks(guild))
-            )
+            self.webhooks_cache.pop(guild.id, None)
+            self.schedule_guild_update(guild)
 
     def in_messages_cache(self, msg_id):
         return any(x.id == msg_id for x in self._connection._messages)
@@ -1,8 +1,9 @@
-import re
 import json
+import asyncio
 import logging
 from functools import wraps
 
+from config import config
 from redis.asyncio import Redis
 from redis.exceptions import ConnectionError
 
@@ -11,6 +12,106 @@ from discordbot.utils import format_guild, format_message, format_user
 log = logging.getLogger(__name__)
 
 redis_store = None
+push_message_script = None
+update_message_script = None
+sadd_if_exists_script = None
+merge_messages_script = None
+
+# seconds before cached guilds, members and users expire
+CACHE_TTL = 60 * 5
+# seconds that writes are collected before being sent in one pipeline
+WRITE_COALESCE_INTERVAL = 0.05
+# pub/sub channel the webapp workers drop their in process caches on
+CACHE_INVALIDATION_CHANNEL = "titan/cache-invalidate"
+# seconds a channel may be read from discord before it counts as abandoned
+MESSAGES_BACKFILL_TTL = 30
+
+# Cached channel messages are kept in two keys:
+#   Queue/channels/{channel_id}/message_ids - sorted set of message ids,
+#       scored by the millisecond timestamp part of the snowflake
+#   Queue/channels/{channel_id}/message_payloads - hash of message id to the
+#       json formatted message
+# A channel that has been read from discord always contains the sentinel
+# member in its sorted set until it is trimmed, so that "cached but empty"
+# can be told apart from "not cached".
+# While a channel is being read from discord it also has
+#   Queue/channels/{channel_id}/message_backfill - set of the sentinel and
+#       the ids of messages deleted since the read began
+# and counts as not cached. Messages pushed or edited in the meantime are
+# written as usual, and the history read is merged in without replacing them.
+# The webapp renders fetch_visitor responses into a third key, which is
+# dropped whenever a message of the channel changes:
+#   Queue/channels/{channel_id}/rendered_messages - hash of "after" snowflake
+#       to the json formatted messages
+#   Queue/channels/{channel_id}/rendered_generation - counter bumped with
+#       every drop, so that the webapp doesn't store messages it read
+#       before the change
+MESSAGES_SENTINEL = "0"
+
+# KEYS: message ids, message payloads, rendered messages, rendered generation
+# ARGV: message id, score, payload, number of messages to keep
+PUSH_MESSAGE_LUA = """
+redis.call("DEL", KEYS[3])
+redis.call("INCR", KEYS[4])
+if redis.call("EXISTS", KEYS[1]) == 0 then
+    return 0
+end
+redis.call("ZADD", KEYS[1], ARGV[2], ARGV[1])
+redis.call("HSET", KEYS[2], ARGV[1], ARGV[3])
+local stale = redis.call("ZRANGE", KEYS[1], 0, -(tonumber(ARGV[4]) + 1))
+if #stale > 0 then
+    redis.call("ZREM", KEYS[1], unpack(stale))
+    redis.call("HDEL", KEYS[2], unpack(stale))
+end
+return 1
+"""
+
+# KEYS: message ids, message payloads, rendered messages, rendered generation,
+#   backfill
+# ARGV: message id, payload
+UPDATE_MESSAGE_LUA = """
+redis.call("DEL", KEYS[3])
+redis.call("INCR", KEYS[4])
+if not redis.call("ZSCORE", KEYS[1], ARGV[1])
+        and redis.call("EXISTS", KEYS[5]) == 0 then
+    return 0
+end
+redis.call("HSET", KEYS[2], ARGV[1], ARGV[2])
+return 1
+"""
+
+# KEYS: message ids, message payloads, rendered messages, rendered generation,
+#   backfill
+# ARGV: id, score and payload of each message read from discord
+MERGE_MESSAGES_LUA = """
+redis.call("DEL", KEYS[3])
+redis.call("INCR", KEYS[4])
+if redis.call("EXISTS", KEYS[5]) == 0 then
+    return 0
+end
+for i = 1, #ARGV, 3 do
+    if redis.call("SISMEMBER", KEYS[5], ARGV[i]) == 0 then
+        redis.call("ZADD", KEYS[1], ARGV[i + 1], ARGV[i])
+        redis.call("HSETNX", KEYS[2], ARGV[i], ARGV[i + 2])
+    end
+end
+for _, message_id in ipairs(redis.call("HKEYS", KEYS[2])) do
+    if not redis.call("ZSCORE", KEYS[1], message_id) then
+        redis.call("HDEL", KEYS[2], message_id)
+    end
+end
+redis.call("DEL", KEYS[5])
+return 1
+"""
+
+# KEYS: set
+# ARGV: member
+SADD_IF_EXISTS_LUA = """
+if redis.call("EXISTS", KEYS[1]) == 0 then
+    return 0
+end
+return redis.call("SADD", KEYS[1], ARGV[1])
+"""
 
 
 def retry(func):
@@ -27,42 +128,117 @@ def retry(func):
 
 
 async def init_redis(url):
-    global redis_store
+    global redis_store, push_message_script, update_message_script
+    global sadd_if_exists_script, merge_messages_script
     redis_store = await Redis.from_url(url, decode_responses=True)
+    push_message_script = redis_store.register_script(PUSH_MESSAGE_LUA)
+    update_message_script = redis_store.register_script(UPDATE_MESSAGE_LUA)
+    sadd_if_exists_script = redis_store.register_script(SADD_IF_EXISTS_LUA)
+    merge_messages_script = redis_store.register_script(MERGE_MESSAGES_LUA)
 
 
-@retry
-async def set_scan_json(key, dict_key, dict_value_pattern):
-    if not await redis_store.exists(key):
-        return None, None
+def message_keys(channel_id):
+    return (
+        f"Queue/channels/{channel_id}/message_ids",
+        f"Queue/channels/{channel_id}/message_payloads",
+    )
 
-    for the_member in await redis_store.smembers(key):
-        # the_member = await member
-        if not the_member:
-            continue
 
-        parsed = json.loads(the_member)
-        if re.match(str(dict_value_pattern), str(parsed[dict_key])):
-            return the_member, parsed
+def messages_backfill_key(channel_id):
+    return f"Queue/channels/{channel_id}/message_backfill"
 
-    return None, None
+
+def rendered_messages_keys(channel_id):
+    return (
+        f"Queue/channels/{channel_id}/rendered_messages",
+        f"Queue/channels/{channel_id}/rendered_generation",
+    )
+
+
+def drop_rendered_messages(pipe, channel_id):
+    rendered_key, generation_key = rendered_messages_keys(channel_id)
+    pipe.delete(rendered_key)
+    pipe.incr(generation_key)
+
+
+def message_score(message_id):
+    # milliseconds since the discord epoch, small enough to be exact as a
+    # redis score; ids within the same millisecond sort lexicographically
+    return int(message_id) >> 22
+
+
+# batches writes from concurrent gateway events into one pipeline, sent
+# `interval` seconds after the first pending write; only the last write to each
+# key is sent
+class CoalescingWriter:
+    def __init__(self, interval):
+        self.interval = interval
+        self.pending = {}
+        self.flush_task = None
+
+    def set(self, key, value, **kwargs):
+        if kwargs.get("xx") and (pending := self.pending.get(key)):
+            method, _, pending_kwargs = pending
+            # the key is deleted before this write would reach redis
+            if method == "delete":
+                return
+            # the key may not exist until the pending write creates it
+            if not pending_kwargs.get("xx"):
+                kwargs = {k: v for k, v in kwargs.items() if k != "xx"}
+
+        self.pending[key] = ("set", (key, value), kwargs)
+        self.schedule_flush()
+
+    def delete(self, key):
+        self.pending[key] = ("delete", (key,), {})
+        self.schedule_flush()
+
+    def publish(self, channel, message):
+        # sent after the writes already pending, so that subscribers see them
+        self.pending[("publish", channel, message)] = (
+            "publish",
+            (channel, message),
+            {},
+        )
+        self.schedule_flush()
+
+    def schedule_flush(self):
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.get_running_loop().create_task(
+                self.flush_later()
+            )
+
+    async def flush_later(self):
+        # writes made while a flush is running go out in the next one, so
+        # that pipelines reach redis in the order they were queued
+        while self.pending:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    async def drain(self):
+        if self.flush_task is not None:
+            await self.flush_task
+
+    async def flush(self):
+        commands, self.pending = list(self.pending.values()), {}
+        if not commands:
+            return
+
+        try:
+            await execute_commands(commands)
+        except Exception:
+            log.exception("Could not write %s cached keys", len(commands))
 
 
 @retry
-async def enforce_expiring_key(key, ttl_override=None):
-    if ttl_override:
-        await redis_store.expire(key, ttl_override)
-        return
+async def execute_commands(commands):
+    async with redis_store.pipeline(transaction=False) as pipe:
+        for method, args, kwargs in commands:
+            getattr(pipe, method)(*args, **kwargs)
+        await pipe.execute()
 
-    ttl = await redis_store.ttl(key)
-    if ttl >= 0:
-        new_ttl = ttl
-    elif ttl == -1:
-        new_ttl = 60 * 5  # 5 minutes
-    else:
-        new_ttl = 0
 
-    await redis_store.expire(key, new_ttl)
+writer = CoalescingWriter(WRITE_COALESCE_INTERVAL)
 
 
 @retry
@@ -70,21 +246,51 @@ async def push_message(message):
     if not message.guild:
         return
 
-    key = f"Queue/channels/{message.channel.id}/messages"
-    if not await redis_store.exists(key):
-        return
+    await push_message_script(
+        keys=[
+            *message_keys(message.channel.id),
+            *rendered_messages_keys(message.channel.id),
+        ],
+        args=[
+            message.id,
+            message_score(message.id),
+            json.dumps(format_message(message), separators=(",", ":")),
+            config["message-cache-size"],
+        ],
+    )
 
-    message = format_message(message)
-    await redis_store.sadd(key, json.dumps(message, separators=(",", ":")))
+
+@retry
+async def begin_messages_backfill(channel):
+    index_key, _ = message_keys(channel.id)
+    backfill_key = messages_backfill_key(channel.id)
+
+    # prime the channel before reading its history, so that messages sent
+    # while it is read are pushed instead of lost
+    async with redis_store.pipeline(transaction=True) as pipe:
+        pipe.zadd(index_key, {MESSAGES_SENTINEL: 0}, nx=True)
+        pipe.sadd(backfill_key, MESSAGES_SENTINEL)
+        pipe.expire(backfill_key, MESSAGES_BACKFILL_TTL)
+        await pipe.execute()
 
 
 @retry
-async def add_messages(channel, messages):
-    key = f"Queue/channels/{channel.id}/messages"
-    await redis_store.sadd(
-        key,
-        "",
-        *[json.dumps(m, separators=(",", ":")) for m in messages],
+async def merge_messages(channel, messages):
+    await merge_messages_script(
+        keys=[
+            *message_keys(channel.id),
+            *rendered_messages_keys(channel.id),
+            messages_backfill_key(channel.id),
+        ],
+        args=[
+            arg
+            for m in messages
+            for arg in (
+                m["id"],
+                message_score(m["id"]),
+                json.dumps(m, separators=(",", ":")),
+            )
+        ],
     )
 
 
@@ -93,42 +299,90 @@ async def delete_message(message):
     if not message.guild:
         return
 
-    key = f"Queue/channels/{message.channel.id}/messages"
-    if not await redis_store.exists(key):
-        return
-
-    unformatted_item, formatted_item = await set_scan_json(
-        key, "id", message.id
-    )
-    if formatted_item:
-        await redis_store.srem(key, unformatted_item)
+    index_key, payload_key = message_keys(message.channel.id)
+    async with redis_store.pipeline(transaction=True) as pipe:
+        pipe.zrem(index_key, message.id)
+        pipe.hdel(payload_key, message.id)
+        drop_rendered_messages(pipe, message.channel.id)
+        # keep a running history read from adding it back
+        await sadd_if_exists_script(
+            keys=[messages_backfill_key(message.channel.id)],
+            args=[message.id],
+            client=pipe,
+        )
+        await pipe.execute()
 
 
 @retry
 async def delete_messages(channel):
-    key = f"Queue/channels/{channel.id}/messages"
-    await redis_store.delete(key)
+    async with redis_store.pipeline(transaction=True) as pipe:
+        pipe.delete(
+            *message_keys(channel.id), messages_backfill_key(channel.id)
+        )
+        drop_rendered_messages(pipe, channel.id)
+        await pipe.execute()
 
 
 @retry
-async def update_message(message):
-    await delete_message(message)
-    await push_message(message)
+async def delete_channels_messages(channels):
+    async with redis_store.pipeline(transaction=False) as pipe:
+        for channel in channels:
+            pipe.delete(
+                *message_keys(channel.id),
+                messages_backfill_key(channel.id),
+                # set of json messages used before the sorted set layout
+                f"Queue/channels/{channel.id}/messages",
+            )
+            drop_rendered_messages(pipe, channel.id)
+        await pipe.execute()
 
 
 @retry
-async def add_members(guild_id, member_ids):
-    key = f"Queue/guilds/{guild_id}/members"
-    await redis_store.sadd(key, *member_ids)
+async def get_messages(channel, limit):
+    # None if the channel is not cached or is still being read
+    index_key, payload_key = message_keys(channel.id)
+
+    async with redis_store.pipeline(transaction=False) as pipe:
+        pipe.exists(messages_backfill_key(channel.id))
+        # one extra in case the sentinel is amongst them
+        pipe.zrevrange(index_key, 0, limit)
+        backfilling, message_ids = await pipe.execute()
+    if backfilling or not message_ids:
+        return None
+
+    message_ids = [m for m in message_ids if m != MESSAGES_SENTINEL][:limit]
+    if not message_ids:
+        return []
+
+    payloads = await redis_store.hmget(payload_key, message_ids)
+    return [json.loads(p) for p in payloads if p]
+
+
+@retry
+async def update_message(message):
+    if not message.guild:
+        return
+
+    await update_message_script(
+        keys=[
+            *message_keys(message.channel.id),
+            *rendered_messages_keys(message.channel.id),
+            messages_backfill_key(message.channel.id),
+        ],
+        args=[
+            message.id,
+            json.dumps(format_message(message), separators=(",", ":")),
+        ],
+    )
 
 
 @retry
 async def add_member(member):
-    if await redis_store.exists(f"Queue/guilds/{member.guild.id}/members"):
-        await redis_store.sadd(
-            f"Queue/guilds/{member.guild.id}/members",
-            json.dumps({"user_id": member.id}, separators=(",", ":")),
-        )
+    # only add to member lists that have been cached in full
+    await sadd_if_exists_script(
+        keys=[f"Queue/guilds/{member.guild.id}/members"],
+        args=[json.dumps({"user_id": member.id}, separators=(",", ":"))],
+    )
 
 
 @retry
@@ -140,29 +394,52 @@ async def remove_member(member, guild=None):
         f"Queue/guilds/{guild.id}/members",
         json.dumps({"user_id": member.id}, separators=(",", ":")),
     )
-    await redis_store.delete(f"Queue/guilds/{guild.id}/members/{member.id}")
+    # through the writer, so that a pending or running flush can't write
+    # the member back after it was deleted
+    writer.delete(f"Queue/guilds/{guild.id}/members/{member.id}")
+    # makes the webapp check the user's membership on their next heartbeat
+    writer.delete(f"UserStatus/{guild.id}/AuthenticatedUsers/{member.id}")
 
 
-@retry
 async def add_member_to_guild(guild, member):
-    key = f"Queue/guilds/{guild.id}/members/{member.id}"
-    await redis_store.set(
-        key, json.dumps(format_user(member), separators=(",", ":"))
+    writer.set(
+        f"Queue/guilds/{guild.id}/members/{member.id}",
+        json.dumps(format_user(member), separators=(",", ":")),
+        ex=CACHE_TTL,
     )
-    await enforce_expiring_key(key)
 
 
 @retry
+async def add_members_to_guild(guild, members, member_ids=None):
+    # member_ids, when given, replaces the member id set in the same transaction
+    async with redis_store.pipeline(transaction=member_ids is not None) as pipe:
+        if member_ids is not None:
+            key = f"Queue/guilds/{guild.id}/members"
+            pipe.delete(key)
+            if member_ids:
+                pipe.sadd(key, *member_ids)
+        for member in members:
+            pipe.set(
+                f"Queue/guilds/{guild.id}/members/{member.id}",
+                json.dumps(format_user(member), separators=(",", ":")),
+                ex=CACHE_TTL,
+            )
+        await pipe.execute()
+
+
 async def remove_member_from_guild(guild, user_id):
-    key = f"Queue/guilds/{guild.id}/members/{user_id}"
-    await redis_store.set(key, "")
-    await enforce_expiring_key(key, 15)
+    writer.set(f"Queue/guilds/{guild.id}/members/{user_id}", "", ex=15)
 
 
-@retry
 async def update_member(member):
-    await remove_member(member)
-    await add_member(member)
+    # refresh the member if it is cached, without caching every member that
+    # happens to change
+    writer.set(
+        f"Queue/guilds/{member.guild.id}/members/{member.id}",
+        json.dumps(format_user(member), separators=(",", ":")),
+        ex=CACHE_TTL,
+        xx=True,
+    )
 
 
 @retry
@@ -170,44 +447,45 @@ async def ban_member(guild, user):
     await remove_member(user, guild)
 
 
-@retry
 async def add_named_member_to_guild(guild, query, member_id):
-    key = f"Queue/custom/guilds/{guild.id}/member_named/{query}"
-    await redis_store.set(key, member_id)
-    await enforce_expiring_key(key)
+    writer.set(
+        f"Queue/custom/guilds/{guild.id}/member_named/{query}",
+        member_id,
+        ex=CACHE_TTL,
+    )
 
 
-@retry
 async def delete_guild(guild):
-    await redis_store.delete(f"Queue/guilds/{guild.id}")
+    writer.delete(f"Queue/guilds/{guild.id}")
 
 
-@retry
 async def update_guild(guild, server_webhooks=None):
-    key = f"Queue/guilds/{guild.id}"
-
-    if await redis_store.exists(key):
-        await delete_guild(guild)
-
-    await redis_store.set(
-        key,
+    writer.set(
+        f"Queue/guilds/{guild.id}",
         json.dumps(format_guild(guild, server_webhooks), separators=(",", ":")),
+        ex=CACHE_TTL,
     )
 
-    await enforce_expiring_key(key)
+
+async def invalidate_guild_emojis(guild):
+    writer.publish(
+        CACHE_INVALIDATION_CHANNEL,
+        json.dumps({"cache": "guild_emojis", "key": str(guild.id)}),
+    )
 
 
-# Queue/channels/{channel.id}/messages"
+# Queue/channels/{channel.id}/message_ids
+# Queue/channels/{channel.id}/message_payloads
+# Queue/channels/{channel.id}/rendered_messages
+# Queue/channels/{channel.id}/rendered_generation
 # Queue/guilds/{guild.id}/members
 # Queue/guilds/{guild.id}/members/{member.id}
 # Queue/guilds/{guild.id}
 
 
-@retry
 async def add_user(user_id, user_formatted):
-    key = f"Queue/users/{user_id}"
-
-    await redis_store.set(
-        key, json.dumps(user_formatted, separators=(",", ":"))
+    writer.set(
+        f"Queue/users/{user_id}",
+        json.dumps(user_formatted, separators=(",", ":")),
+        ex=CACHE_TTL,
     )
-    await enforce_expiring_key(key)
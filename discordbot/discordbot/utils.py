@@ -1,3 +1,6 @@
+import json
+import asyncio
+import hashlib
 from email import utils as emailutils
 
 from discord import Role
@@ -119,19 +122,36 @@ def format_formatted_emojis(emojis):
 
 
 def format_guild(guild, webhooks=None):
+    roles = format_roles_list(guild.roles)
+    channels = format_channels_list(guild.channels)
     return {
         "id": str(guild.id),
         "name": guild.name,
         "icon": guild.icon.key if guild.icon else None,
         "icon_url": str(guild.icon),
         "owner_id": guild.owner_id,
-        "roles": format_roles_list(guild.roles),
-        "channels": format_channels_list(guild.channels),
+        "roles": roles,
+        "channels": channels,
         "webhooks": format_webhooks_list(webhooks or []),
         "emojis": format_emojis_list(guild.emojis),
+        "permissions_version": permissions_version(
+            guild.owner_id, roles, channels
+        ),
+        # role id -> index of the role in "roles"
+        "role_index": {role["id"]: i for i, role in enumerate(roles)},
+        "everyone_permissions": guild.default_role.permissions.value,
     }
 
 
+def permissions_version(owner_id, roles, channels):
+    # lets the webapp reuse channel permissions computed for an unchanged
+    # guild, must match get_guild_permissions_version in the webapp
+    payload = json.dumps(
+        [owner_id, roles, channels], sort_keys=True, separators=(",", ":")
+    )
+    return hashlib.blake2b(payload.encode(), digest_size=16).hexdigest()
+
+
 def format_channel(channel):
     return {
         "id": str(channel.id),
@@ -294,3 +314,18 @@ async def guild_webhooks(guild):
         return await guild.webhooks()
     else:
         return []
+
+
+# key -> task of a lookup that is in progress, see single_flight
+_in_flight = {}
+
+
+async def single_flight(key, func, *args, **kwargs):
+    # the task is shielded, so a caller going away doesn't cancel it for the
+    # others asking for the same key
+    if (task := _in_flight.get(key)) is None:
+        task = asyncio.ensure_future(func(*args, **kwargs))
+        _in_flight[key] = task
+        task.add_done_callback(lambda _: _in_flight.pop(key, None))
+
+    return await asyncio.shield(task)
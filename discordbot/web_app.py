@@ -3,14 +3,22 @@ import logging
 from pprint import pformat
 
 import discord
-from quart import Quart, jsonify, request
+from config import config
+from quart import Quart, abort, jsonify, request
 
 from discordbot import redis_cache
-from discordbot.utils import format_guild, format_message, format_user, guild_webhooks
+from discordbot.utils import (
+    format_guild,
+    format_message,
+    format_user,
+    single_flight,
+)
 
 log = logging.getLogger(__name__)
 
 DEFAULT_CHANNEL_MESSAGES_LIMIT = 50
+DEFAULT_MEMBER_LIST_LIMIT = 1000
+MAX_MEMBER_LIST_LIMIT = 5000
 
 bot = None
 web_app = Quart(__name__)
@@ -33,16 +41,43 @@ async def on_get_channel_messages_http(channel_id):
 
     limit = int(request.args.get("limit", DEFAULT_CHANNEL_MESSAGES_LIMIT))
 
-    await redis_cache.delete_messages(channel)
-
     me = channel.guild.get_member(bot.user.id)
     if not channel.permissions_for(me).read_messages:
         log.error(
             "Do not have permission to read messages from channel %s",
             channel.id,
         )
+        await redis_cache.delete_messages(channel)
         return []
 
+    # The cache is dropped on startup and whenever a shard starts a new
+    # gateway session, so if it exists it has seen every message event.
+    if config["message-cache-authoritative"]:
+        messages = await redis_cache.get_messages(channel, limit)
+        if messages is not None:
+            log.info(
+                "serving %s cached messages for channel %s",
+                len(messages),
+                channel.id,
+            )
+            return messages
+
+    # every embed polling a channel asks at once when it goes busy, let
+    # them share a single history request to discord
+    messages = await single_flight(
+        ("channel_messages", channel.id, limit),
+        backfill_channel_messages,
+        channel,
+        limit,
+    )
+
+    log.debug("on_get_channel_messages_http returning %s", len(messages))
+    return messages
+
+
+async def backfill_channel_messages(channel, limit):
+    await redis_cache.begin_messages_backfill(channel)
+
     log.info("reading %s messages for channel %s", limit, channel.id)
     messages = [
         format_message(message)
@@ -51,10 +86,9 @@ async def on_get_channel_messages_http(channel_id):
     log.info("Read messages from channel %s", channel.id)
 
     log.info("Adding messages for channel to redis")
-    await redis_cache.add_messages(channel, messages)
+    await redis_cache.merge_messages(channel, messages)
     log.info("Done messages for channel to redis")
 
-    log.debug("on_get_channel_messages_http returning %s", len(messages))
     return messages
 
 
@@ -66,7 +100,12 @@ async def on_get_guild_member_http(guild_id, user_id):
         return {}
 
     if not (member := guild.get_member(int(user_id))):
-        members = await guild.query_members(user_ids=[user_id], cache=True)
+        members = await single_flight(
+            ("query_members", guild.id, int(user_id)),
+            guild.query_members,
+            user_ids=[user_id],
+            cache=True,
+        )
 
         if not len(members):
             await redis_cache.remove_member_from_guild(guild, user_id)
@@ -80,6 +119,49 @@ async def on_get_guild_member_http(guild_id, user_id):
     return result
 
 
+@web_app.get("/guild/<guild_id>/member_batch")
+async def on_get_guild_member_batch_http(guild_id):
+    log.info("on_get_guild_member_batch_http")
+
+    if not (guild := bot.get_guild(int(guild_id))):
+        return {}
+
+    user_ids = {
+        int(user_id)
+        for user_id in request.args.get("user_ids", "").split(",")
+        if user_id.isdigit()
+    }
+
+    members = {}
+    missing = []
+    for user_id in user_ids:
+        if member := guild.get_member(user_id):
+            members[member.id] = member
+        else:
+            missing.append(user_id)
+
+    # discord allows querying up to 100 members by id at once
+    for i in range(0, len(missing), 100):
+        for member in await guild.query_members(
+            user_ids=missing[i : i + 100], cache=True
+        ):
+            members[member.id] = member
+
+    await redis_cache.add_members_to_guild(guild, members.values())
+    for user_id in user_ids - members.keys():
+        await redis_cache.remove_member_from_guild(guild, user_id)
+
+    result = {
+        str(user_id): format_user(members[user_id])
+        if user_id in members
+        else {}
+        for user_id in user_ids
+    }
+    log.debug("on_get_guild_member_batch_http returning\n%s", pformat(result))
+
+    return result
+
+
 # TODO - this looks broken
 @web_app.get("/guild/<guild_id>/member-name/<query>")
 async def on_get_guild_member_named_http(guild_id, query):
@@ -125,18 +207,60 @@ async def on_list_guild_members_http(guild_id):
     if not (guild := bot.get_guild(int(guild_id))):
         return jsonify([])
 
-    member_ids = []
-    for member in guild.members:
-        member_ids.append(
-            json.dumps({"user_id": member.id}, separators=(",", ":"))
-        )
-        await redis_cache.add_member_to_guild(guild, member)
+    member_ids = [
+        json.dumps({"user_id": member.id}, separators=(",", ":"))
+        for member in guild.members
+    ]
+    await redis_cache.add_members_to_guild(guild, guild.members, member_ids)
 
-    await redis_cache.add_members(guild.id, member_ids)
     log.debug("on_list_guild_members_http returning\n%s", pformat(member_ids))
     return jsonify(member_ids)
 
 
+@web_app.get("/guild/<guild_id>/member_list")
+async def on_list_guild_members_full_http(guild_id):
+    log.info("on_list_guild_members_full_http")
+
+    if not (guild := bot.get_guild(int(guild_id))):
+        return {"members": [], "next_offset": None}
+
+    try:
+        offset = int(request.args.get("offset", 0))
+        limit = min(
+            int(request.args.get("limit", DEFAULT_MEMBER_LIST_LIMIT)),
+            MAX_MEMBER_LIST_LIMIT,
+        )
+    except ValueError:
+        abort(400)
+    if offset < 0 or limit < 1:
+        abort(400)
+
+    # sort so that pages stay stable between requests
+    all_members = sorted(guild.members, key=lambda m: m.id)
+    page = all_members[offset : offset + limit]
+
+    # the complete id set is written with the first page only, so the webapp
+    # never sees a partial member list in redis
+    member_ids = None
+    if offset == 0:
+        member_ids = [
+            json.dumps({"user_id": member.id}, separators=(",", ":"))
+            for member in all_members
+        ]
+    await redis_cache.add_members_to_guild(guild, page, member_ids)
+
+    next_offset = offset + limit
+    result = {
+        "members": [format_user(member) for member in page],
+        "next_offset": next_offset if next_offset < len(all_members) else None,
+    }
+    log.debug(
+        "on_list_guild_members_full_http returning %s members",
+        len(result["members"]),
+    )
+    return result
+
+
 @web_app.get("/guild/<guild_id>")
 async def on_get_guild_http(guild_id):
     log.info("on_get_guild_http")
@@ -144,7 +268,7 @@ async def on_get_guild_http(guild_id):
     if not (guild := bot.get_guild(int(guild_id))):
         log.info("no guild found")
         return {}
-    server_webhooks = await guild_webhooks(guild)
+    server_webhooks = await bot.get_guild_webhooks(guild)
 
     await redis_cache.update_guild(guild, server_webhooks=server_webhooks)
 
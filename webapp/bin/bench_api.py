@@ -0,0 +1,92 @@
+#!/usr/bin/python3
+"""Measure the latency of the embed's polling api endpoints.
+
+Run it once against a webapp started with TITAN_API_PREFETCH= (empty, which
+turns prefetching off) and once without, to compare the sequential and the
+prefetched lookups:
+
+    python bin/bench_api.py http://localhost:8080 <guild id> <channel id>
+
+Cookies are not kept, so every request gets a session (and rate limit
+bucket) of its own. fetch needs the signed session of an embed user, passed
+with --authorization (the value the embed sends in its authorization
+header); its requests share one rate limit bucket, so responses that were
+rate limited are counted but left out of the latencies.
+"""
+
+import time
+import argparse
+import statistics
+from http.cookiejar import DefaultCookiePolicy
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+
+def percentile(latencies, pct):
+    index = round(pct / 100 * (len(latencies) - 1))
+    return sorted(latencies)[index]
+
+
+def run_benchmark(url, params, headers, total, concurrency):
+    # latencies (ms) leave out the responses that were rate limited
+    session = requests.Session()
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=concurrency)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    def timed_request(_):
+        start = time.perf_counter()
+        response = session.get(url, params=params, headers=headers)
+        return time.perf_counter() - start, response.status_code
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(timed_request, range(total)))
+    elapsed = time.perf_counter() - start
+
+    latencies = [t * 1000 for t, code in results if code != 429]
+    return {
+        "throughput": len(results) / elapsed,
+        "rate_limited": len(results) - len(latencies),
+        "latencies": latencies,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("url", help="base url of the webapp")
+    parser.add_argument("guild_id")
+    parser.add_argument("channel_id")
+    parser.add_argument(
+        "--endpoint",
+        default="fetch_visitor",
+        choices=["fetch", "fetch_visitor"],
+    )
+    parser.add_argument("--authorization")
+    parser.add_argument("-n", "--requests", type=int, default=500)
+    parser.add_argument("-c", "--concurrency", type=int, default=10)
+    args = parser.parse_args()
+
+    url = f"{args.url.rstrip('/')}/api/{args.endpoint}"
+    params = {"guild_id": args.guild_id, "channel_id": args.channel_id}
+    headers = {}
+    if args.authorization:
+        headers["authorization"] = args.authorization
+
+    stats = run_benchmark(url, params, headers, args.requests, args.concurrency)
+    if not (latencies := stats["latencies"]):
+        print(f"all {stats['rate_limited']} requests were rate limited")
+        return
+
+    print(f"{url}: {args.requests} requests, concurrency {args.concurrency}")
+    print(f"throughput: {stats['throughput']:.1f} requests/s")
+    print(f"rate limited (excluded): {stats['rate_limited']}")
+    print(f"mean: {statistics.mean(latencies):.1f} ms")
+    for pct in (50, 90, 99):
+        print(f"p{pct}: {percentile(latencies, pct):.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/python3
+"""Measure how api throughput scales with the number of gunicorn workers.
+
+Starts the webapp (with the environment of this shell) once per worker
+count, benchmarks it with bench_api and prints one line per run. Run it
+from the webapp directory:
+
+    python bin/load_test.py <guild id> <channel id> --workers 1 2 4
+"""
+
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+import requests
+from bench_api import percentile, run_benchmark
+
+
+def wait_until_up(url, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            requests.get(url, timeout=1)
+            return True
+        except requests.exceptions.ConnectionError:
+            time.sleep(0.5)
+    return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("guild_id")
+    parser.add_argument("channel_id")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("-n", "--requests", type=int, default=2000)
+    parser.add_argument("-c", "--concurrency", type=int, default=50)
+    args = parser.parse_args()
+
+    base_url = f"http://127.0.0.1:{args.port}"
+    url = f"{base_url}/api/fetch_visitor"
+    params = {"guild_id": args.guild_id, "channel_id": args.channel_id}
+
+    print("workers  requests/s  p50 ms  p99 ms  rate limited")
+    for workers in args.workers:
+        env = dict(
+            os.environ,
+            TITAN_WEBAPP_WORKERS=str(workers),
+            TITAN_WEBAPP_BIND=f"127.0.0.1:{args.port}",
+        )
+        server = subprocess.Popen(
+            ["gunicorn", "titanembeds.app:app"],
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        try:
+            if not wait_until_up(base_url):
+                sys.exit(f"webapp with {workers} workers did not start")
+
+            # let every worker import the app before measuring
+            time.sleep(2)
+            stats = run_benchmark(
+                url, params, {}, args.requests, args.concurrency
+            )
+        finally:
+            server.terminate()
+            server.wait()
+
+        latencies = stats["latencies"] or [0]
+        print(
+            f"{workers:>7}  {stats['throughput']:>10.1f}"
+            f"  {percentile(latencies, 50):>6.1f}"
+            f"  {percentile(latencies, 99):>6.1f}"
+            f"  {stats['rate_limited']:>12}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -24,6 +24,27 @@ config = {
     "bot-http-port": env.get("TITAN_BOT_PORT", 8080),
     "bot-http-url": env.get("TITAN_BOT_ADDR", "localhost"),
     "bot-http-over-ipv6": env.get("TITAN_BOT_IPV6", False),
+    # connection pool and timeouts (seconds) used when calling the bot
+    "bot-http-pool-size": int(env.get("TITAN_BOT_HTTP_POOL_SIZE", 50)),
+    "bot-http-connect-timeout": float(
+        env.get("TITAN_BOT_HTTP_CONNECT_TIMEOUT", 1)
+    ),
+    "bot-http-read-timeout": float(env.get("TITAN_BOT_HTTP_READ_TIMEOUT", 5)),
+    "bot-http-retries": int(env.get("TITAN_BOT_HTTP_RETRIES", 2)),
+    "bot-http-retry-backoff": float(
+        env.get("TITAN_BOT_HTTP_RETRY_BACKOFF", 0.2)
+    ),
+    # how long a resolved bot address is reused before looking it up again
+    "bot-http-addr-ttl": int(env.get("TITAN_BOT_HTTP_ADDR_TTL", 60)),
+    # read channel messages from the bot's redis cache, must match the bot
+    "message-cache-authoritative": env.get(
+        "TITAN_BOT_MESSAGE_CACHE_AUTHORITATIVE", "true"
+    ).lower()
+    in ("1", "true", "yes"),
+    # appended to static file urls, shared by all workers (gunicorn.conf.py)
+    "app-start-stamp": env.get("TITAN_APP_START_STAMP"),
+    # overlap the bot lookups of api requests in green threads (eventlet only)
+    "api-prefetch": env.get("TITAN_API_PREFETCH", True),
     # are we running behind a proxy which terminates TLS - cannot be used with `enable-ssl`
     "https-proxy": env.get("TITAN_HTTPS_PROXY", False),
     # redirect all http to https - cannot be used with `https-proxy`
@@ -0,0 +1,27 @@
+# Loaded by gunicorn from the working directory (webapp/).
+#
+# Running more than one worker is supported for clients that connect to the
+# /gateway socket.io namespace over websockets only, as embed.js does: a
+# websocket stays on the worker that accepted it, and events are fanned out
+# between workers through the redis message queue. Clients that fall back to
+# long polling need sticky sessions, which gunicorn cannot provide - run one
+# single worker instance per port behind nginx's ip_hash upstream instead
+# (see etc/nginx/nginx.conf).
+import os
+import time
+
+bind = os.environ.get("TITAN_WEBAPP_BIND", "0.0.0.0:8080")
+worker_class = "eventlet"
+workers = int(os.environ.get("TITAN_WEBAPP_WORKERS", 1))
+
+# The app must be imported in every worker, after the fork: each worker opens
+# its own redis and database connections and listens for cache invalidations.
+preload_app = False
+
+loglevel = "info"
+accesslog = "-"
+errorlog = "-"
+access_log_format = "%(h)s %(l)s %(u)s '%(r)s' %(s)s %(b)s '%(f)s' '%(a)s'"
+
+# one cache busting stamp for the static files of every worker
+os.environ.setdefault("TITAN_APP_START_STAMP", str(int(time.time())))
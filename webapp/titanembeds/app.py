@@ -40,7 +40,9 @@ from .blueprints import admin, api, embed, gateway, user
 from .database import db
 from .discord_rest import discord_api
 from .flask_cdn import CDN
+from .local_cache import init_invalidation_listener
 from .redis_cache import init_redis
+from .request_cache import get_saved_lookups
 
 
 class Error(Exception):
@@ -51,7 +53,7 @@ class ConfigError(Error):
     pass
 
 
-app_start_stamp = time.time()
+app_start_stamp = config["app-start-stamp"] or time.time()
 
 app = Flask(__name__.split(".")[0], static_folder="static")
 
@@ -131,6 +133,7 @@ babel = Babel()
 babel.init_app(app)
 
 init_redis(config["redis-uri"])
+init_invalidation_listener()
 with app.app_context():
     init_application_settings()
     discord_api.init_discordrest()
@@ -193,6 +196,14 @@ def licence():
     return render_template("LICENCE")
 
 
+@app.after_request
+def report_saved_lookups(response):
+    if saved := get_saved_lookups():
+        response.headers["X-Titan-Lookups-Saved"] = str(sum(saved.values()))
+        log.debug("%s saved lookups: %s", request.path, dict(saved))
+    return response
+
+
 @app.context_processor
 def context_processor():
     return {
@@ -29,10 +29,14 @@ from titanembeds.database import (
     db,
     get_administrators_list,
     get_titan_token,
+    invalidate_application_settings,
+    invalidate_disabled_guilds,
+    invalidate_guild_settings,
+    is_guild_disabled,
     list_disabled_guilds,
     set_titan_token,
 )
-from titanembeds.redis_cache import get_online_embed_user_keys
+from titanembeds.redis_cache import count_online_embed_users
 from titanembeds.utils import generate_guild_icon_url
 
 admin = Blueprint("admin", __name__)
@@ -54,9 +58,9 @@ def is_admin(f):
 
 
 def get_online_users_count():
-    users = get_online_embed_user_keys()
-    auths = len(users["AuthenticatedUsers"])
-    unauths = len(users["UnauthenticatedUsers"])
+    users = count_online_embed_users()
+    auths = users["AuthenticatedUsers"]
+    unauths = users["UnauthenticatedUsers"]
     return {"authenticated": auths, "guest": unauths, "total": auths + unauths}
 
 
@@ -375,6 +379,7 @@ def update_administrate_guild(guild_id):
         guild.banned_words = json.dumps(list(banned_words))
 
     db.session.commit()
+    invalidate_guild_settings(guild_id)
 
     emit(
         "guest_icon_change",
@@ -511,12 +516,13 @@ def get_disabled_guilds():
 @is_admin
 def post_disabled_guilds():
     guild_id = request.form.get("guild_id", None)
-    if guild_id in list_disabled_guilds():
+    if is_guild_disabled(guild_id):
         abort(409)
 
     guild = DisabledGuilds(guild_id)
     db.session.add(guild)
     db.session.commit()
+    invalidate_disabled_guilds()
 
     return "", 204
 
@@ -525,7 +531,7 @@ def post_disabled_guilds():
 @is_admin
 def delete_disabled_guilds():
     guild_id = request.form.get("guild_id", None)
-    if guild_id not in list_disabled_guilds():
+    if not is_guild_disabled(guild_id):
         abort(409)
 
     guild = (
@@ -535,6 +541,7 @@ def delete_disabled_guilds():
     )
     db.session.delete(guild)
     db.session.commit()
+    invalidate_disabled_guilds()
 
     return "", 204
 
@@ -759,6 +766,7 @@ def application_settings_post():
         settings.donation_goal_end = res
 
     db.session.commit()
+    invalidate_application_settings()
 
     return jsonify(
         {
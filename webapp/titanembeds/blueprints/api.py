@@ -1,9 +1,11 @@
 import re
 import copy
 import json
+import time
 import random
 import logging
 from pprint import pformat
+from functools import lru_cache
 from urllib.parse import urlsplit, parse_qsl
 
 import requests
@@ -14,6 +16,7 @@ from flask import current_app as app
 from flask import jsonify, request, session, url_for
 from flask_socketio import emit
 from itsdangerous.exc import BadSignature
+from redis.exceptions import LockError
 from sqlalchemy import and_
 from titanembeds import bot_http_client, rate_limiter, redis_cache
 from titanembeds.cache_keys import (
@@ -24,7 +27,6 @@ from titanembeds.cache_keys import (
 from titanembeds.database import (
     AuthenticatedUsers,
     DiscordBotsOrgTransactions,
-    Guilds,
     UnauthenticatedBans,
     UnauthenticatedUsers,
     db,
@@ -37,19 +39,25 @@ from titanembeds.decorators import (
     valid_session_required,
 )
 from titanembeds.discord_rest import discord_api
+from titanembeds.local_cache import TTLCache
+from titanembeds.request_cache import prefetch
 from titanembeds.utils import (
     check_guild_existance,
     check_user_in_guild,
     checkUserBanned,
     generate_avatar_url,
+    get_db_guild,
     get_forced_role,
+    get_guild_channel,
     get_guild_channels,
+    get_guild_role_index,
     get_member_roles,
     guild_accepts_visitors,
     guild_query_unauth_users_bool,
     guild_unauthcaptcha_enabled,
     guild_webhooks_enabled,
     int_or_none,
+    invalidate_guest_statuses,
     serializer,
     update_user_status,
     user_unauthenticated,
@@ -61,18 +69,25 @@ CAPTCHA_URL = "https://www.google.com/recaptcha/api/siteverify"
 log = logging.getLogger(__name__)
 api = Blueprint("api", __name__)
 
+# guild id -> compiled emoji matcher, invalidated by the bot on emoji updates
+guild_emojis_cache = TTLCache("guild_emojis", maxsize=1024, ttl=300)
+
 
 @api.after_request
 def after_request(response):
-    if response.is_json:
-        data = response.get_json()
-
-        try:
-            data["session"] = serializer.dumps(copy.deepcopy(dict(session)))
-        except TypeError:  # /user/<guild_id> returns a list
-            pass
+    if not response.is_json:
+        return response
 
-        response.set_data(json.dumps(data))
+    # /user/<guild_id> returns a list. Objects get the session spliced in
+    # as text, so that the body is not parsed and serialized again.
+    body = response.get_data().lstrip()
+    if body.startswith(b"{"):
+        token = serializer.dumps(copy.deepcopy(dict(session)))
+        rest = body[1:].lstrip()
+        separator = b"" if rest.startswith(b"}") else b","
+        response.set_data(
+            b'{"session":' + json.dumps(token).encode() + separator + rest
+        )
 
     return response
 
@@ -91,13 +106,77 @@ def before_request():
         log.error(f"Could not JSON decode auth header value")
 
 
+def get_emoji_matcher(guild_id):
+    """Return a regex matching the guild's `:name:` emojis and a map of
+    emoji name to message token, or a false value if there are none.
+
+    Cached until the bot publishes an emoji update for the guild.
+    """
+
+    def load():
+        if not (guild := bot_http_client.get_guild(guild_id)):
+            return None
+
+        tokens = {}
+        for emoj in guild["emojis"]:
+            animated = "a" if emoj.get("animated") else ""
+            tokens.setdefault(
+                emoj["name"], f"<{animated}:{emoj['name']}:{emoj['id']}>"
+            )
+        if not tokens:
+            return False
+
+        alternation = "|".join(re.escape(name) for name in tokens)
+        return re.compile(f":({alternation}):"), tokens
+
+    return guild_emojis_cache.get_or_load(str(guild_id), load)
+
+
 def parse_emoji(text_to_parse, guild_id):
-    for emoj in get_guild_emojis(guild_id):
-        animated = "a" if emoj.get("animated") else ""
-        text_to_parse = text_to_parse.replace(
-            f":{emoj['name']}:", f"<{animated}:{emoj['name']}:{emoj['id']}>"
-        )
-    return text_to_parse
+    if not (matcher := get_emoji_matcher(guild_id)):
+        return text_to_parse
+
+    regex, tokens = matcher
+    return regex.sub(lambda match: tokens[match.group(1)], text_to_parse)
+
+
+@lru_cache(maxsize=512)
+def get_banned_words_matcher(banned_words, global_included):
+    """Compile a guild's banned words into a single case insensitive regex.
+
+    Keyed on the guild's `banned_words` json so that an edited list compiles
+    a new matcher. Returns the regex and a map of lower cased word to the
+    word as it was banned, or `None` if nothing is banned.
+    """
+    words = set(json.loads(banned_words))
+    if global_included:
+        words = words.union(set(constants.GLOBAL_BANNED_WORDS))
+    words = {word.lower(): word for word in words if word}
+    if not words:
+        return None
+
+    # longest first so that a phrase wins over a word it starts with, and
+    # lookarounds rather than \b since some words start or end with symbols
+    alternation = "|".join(
+        re.escape(word) for word in sorted(words, key=len, reverse=True)
+    )
+    regex = re.compile(rf"(?<!\w)(?:{alternation})(?!\w)", re.IGNORECASE)
+    return regex, words
+
+
+def find_banned_words(db_guild, message):
+    matcher = get_banned_words_matcher(
+        db_guild.banned_words, bool(db_guild.banned_words_global_included)
+    )
+    if not matcher:
+        return []
+
+    regex, words = matcher
+    found = dict.fromkeys(
+        words.get(match.group(0).lower(), match.group(0))
+        for match in regex.finditer(message)
+    )
+    return list(found)
 
 
 def format_post_content(guild_id, message, db_user):
@@ -107,9 +186,7 @@ def format_post_content(guild_id, message, db_user):
     message = message.replace(">", "\>")
     message = parse_emoji(message, guild_id)
 
-    db_guild = (
-        db.session.query(Guilds).filter(Guilds.guild_id == guild_id).first()
-    )
+    db_guild = get_db_guild(guild_id)
 
     max_len = get_post_content_max_len(guild_id)
     if len(message) > max_len:
@@ -146,19 +223,9 @@ def format_post_content(guild_id, message, db_user):
         message = message.replace(match, mention, 1)
 
     if db_guild.banned_words_enabled:
-        banned_words = set(json.loads(db_guild.banned_words))
-        if db_guild.banned_words_global_included:
-            banned_words = banned_words.union(
-                set(constants.GLOBAL_BANNED_WORDS)
-            )
-
-        for word in banned_words:
-            regex = re.compile(rf"\b{word}\b", re.IGNORECASE)
-            if regex.search(message):
-                illegal_post = True
-                illegal_reasons.append(
-                    "The following word is prohibited: " + word
-                )
+        for word in find_banned_words(db_guild, message):
+            illegal_post = True
+            illegal_reasons.append("The following word is prohibited: " + word)
 
     if not guild_webhooks_enabled(guild_id):
         if session["unauthenticated"]:
@@ -186,14 +253,26 @@ def format_everyone_mention(channel, content):
     return content
 
 
-def filter_guild_channel(guild_id, channel_id, force_everyone=False):
-    for chan in get_guild_channels(
-        guild_id, force_everyone, get_forced_role(guild_id)
-    ):
-        if chan["channel"]["id"] == channel_id:
-            return chan
+def prefetch_guild_lookups(guild_id, user_id=None):
+    # overlap the lookups the channel permission checks need with the database
+    # work before them
+    prefetch("guild", bot_http_client.get_guild, guild_id)
+    prefetch(
+        "guild_member",
+        bot_http_client.get_guild_member,
+        guild_id,
+        config["client-id"],
+    )
+    if user_id:
+        prefetch(
+            "guild_member", bot_http_client.get_guild_member, guild_id, user_id
+        )
+
 
-    return None
+def filter_guild_channel(guild_id, channel_id, force_everyone=False):
+    return get_guild_channel(
+        guild_id, channel_id, force_everyone, get_forced_role(guild_id)
+    )
 
 
 def get_online_discord_users(guild_id, embed):
@@ -213,7 +292,54 @@ def get_online_discord_users(guild_id, embed):
     return embed["members"]
 
 
+def get_shared_snapshot(key, ttl, stale_ttl, fetch, *args):
+    """Return the value cached in redis under `key`, computed by
+    `fetch(*args)`.
+
+    The value is refreshed by one worker at a time once it is `ttl` seconds
+    old; the others keep serving the stale value meanwhile (for up to
+    `stale_ttl` seconds), or wait for the first one to be computed.
+    """
+    snapshot = redis_cache.get_snapshot(key)
+    if snapshot and snapshot[0] > time.time() - ttl:
+        return snapshot[1]
+
+    lock = redis_cache.snapshot_refresh_lock(key)
+    if lock.acquire():
+        try:
+            value = fetch(*args)
+            redis_cache.cache_snapshot(key, value, stale_ttl)
+            return value
+        finally:
+            try:
+                lock.release()
+            except LockError:
+                log.warning("Refresh lock of %s expired", key)
+
+    if snapshot:
+        return snapshot[1]
+
+    for _ in range(50):
+        time.sleep(0.1)
+        if snapshot := redis_cache.get_snapshot(key):
+            return snapshot[1]
+
+    # the refreshing worker is stuck, don't keep the request waiting on it
+    return fetch(*args)
+
+
 def get_online_embed_users(guild_id):
+    # every open member list polls this, so it is shared through redis
+    return get_shared_snapshot(
+        f"OnlineEmbedUsers/{guild_id}",
+        redis_cache.ONLINE_USERS_TTL,
+        redis_cache.ONLINE_USERS_STALE_TTL,
+        list_online_embed_users,
+        guild_id,
+    )
+
+
+def list_online_embed_users(guild_id):
     usrs = redis_cache.get_online_embed_user_keys(guild_id)
 
     unauths = (
@@ -239,7 +365,7 @@ def get_online_embed_users(guild_id):
     }
 
     auths = (
-        db.session.query(AuthenticatedUsers)
+        db.session.query(AuthenticatedUsers.client_id)
         .filter(
             AuthenticatedUsers.client_id.in_(usrs["AuthenticatedUsers"]),
             AuthenticatedUsers.guild_id == guild_id,
@@ -248,8 +374,14 @@ def get_online_embed_users(guild_id):
         if usrs["AuthenticatedUsers"]
         else []
     )
-    for user in auths:
-        usrdb = bot_http_client.get_guild_member(guild_id, user.client_id)
+    members = bot_http_client.get_guild_members(
+        guild_id, [user.client_id for user in auths]
+    )
+    for usrdb in members.values():
+        # members that left the guild resolve to an empty dict
+        if not usrdb:
+            continue
+
         meta = {
             "id": str(usrdb["id"]),
             "username": usrdb["username"],
@@ -315,11 +447,7 @@ def send_webhook(content, db_user, file, guild_id, rich_embed, webhook):
     if session["unauthenticated"]:
         username = f"{session['username'][:25]}#{session['user_id']}"
 
-        if (
-            db_guild := db.session.query(Guilds)
-            .filter(Guilds.guild_id == guild_id)
-            .first()
-        ) and db_guild.guest_icon:
+        if (db_guild := get_db_guild(guild_id)) and db_guild.guest_icon:
             avatar = db_guild.guest_icon
         else:
             avatar = url_for(
@@ -350,24 +478,26 @@ def send_webhook(content, db_user, file, guild_id, rich_embed, webhook):
         log.error("Unknown webhook: %s", message)
         return None
 
-    delete_webhook_if_too_much(guild_id)
+    delete_webhook_if_too_much(guild_id, webhook)
     return message
 
 
-def delete_webhook_if_too_much(guild_id):
+def delete_webhook_if_too_much(guild_id, webhook):
     if not guild_webhooks_enabled(guild_id):
         return
 
-    guild = bot_http_client.get_guild(guild_id)
-    titan_webhooks = [
-        w for w in guild["webhooks"] if w["name"].startswith("[Titan] ")
-    ]
+    # the guild was looked up before this request created `webhook`
+    webhooks = bot_http_client.get_guild(guild_id)["webhooks"]
+    if webhook["id"] not in {w["id"] for w in webhooks}:
+        webhooks = [*webhooks, webhook]
+
+    titan_webhooks = [w for w in webhooks if w["name"].startswith("[Titan] ")]
 
-    if len(titan_webhooks) > 0 and len(guild["webhooks"]) >= 8:
+    if len(titan_webhooks) > 0 and len(webhooks) >= 8:
         log.info(
             "Webhook count: %s. guild webhooks: %s.",
             len(titan_webhooks),
-            len(guild["webhooks"]),
+            len(webhooks),
         )
         for wh in titan_webhooks:
             log.info("Deleting excess webhook %s", wh)
@@ -412,6 +542,9 @@ def fetch():
     channel_id = request.args.get("channel_id")
     after_snowflake = request.args.get("after", 0, type=int)
     key = session["user_keys"][guild_id] if user_unauthenticated() else None
+    prefetch_guild_lookups(
+        guild_id, None if user_unauthenticated() else session["user_id"]
+    )
     status = update_user_status(guild_id, session["username"], key)
 
     messages = {}
@@ -447,34 +580,43 @@ def fetch_visitor():
     channel_id = request.args.get("channel_id")
     after_snowflake = request.args.get("after", 0, type=int)
 
+    prefetch_guild_lookups(guild_id)
     if not guild_accepts_visitors(guild_id):
         abort(403)
     if not (chan := filter_guild_channel(guild_id, channel_id, True)):
         abort(404)
 
     if not chan.get("read") or chan["channel"]["type"] != "text":
-        messages = {}
-        status_code = 401
-    else:
+        response = jsonify(messages={})
+        response.status_code = 401
+        return response
+
+    # every visitor of a channel gets the same messages, so they are
+    # rendered once and shared until the bot sees the channel change
+    rendered, generation = redis_cache.get_rendered_messages(
+        channel_id, after_snowflake
+    )
+    if rendered is None:
         messages = bot_http_client.get_channel_messages(
-            guild_id, channel_id, after_snowflake
+            guild_id, channel_id, after_snowflake, none_if_unavailable=True
         )
-        status_code = 200
-
-    response = jsonify(messages=messages)
-    response.status_code = status_code
+        if messages is None:
+            rendered = "[]"
+        else:
+            rendered = json.dumps(messages, separators=(",", ":"))
+            redis_cache.cache_rendered_messages(
+                channel_id, after_snowflake, rendered, generation
+            )
 
-    return response
+    return app.response_class(
+        f'{{"messages":{rendered}}}', mimetype="application/json"
+    )
 
 
 def get_guild_specific_post_limit():
     guild_id = int_or_none(request.form.get("guild_id", None))
 
-    if guild_id and (
-        db_guild := db.session.query(Guilds)
-        .filter(Guilds.guild_id == guild_id)
-        .first()
-    ):
+    if guild_id and (db_guild := get_db_guild(guild_id)):
         seconds = db_guild.post_timeout
     else:
         seconds = 5
@@ -485,11 +627,7 @@ def get_guild_specific_post_limit():
 def get_post_content_max_len(guild_id):
     guild_id = int_or_none(guild_id)
 
-    if guild_id and (
-        db_guild := db.session.query(Guilds)
-        .filter(Guilds.guild_id == guild_id)
-        .first()
-    ):
+    if guild_id and (db_guild := get_db_guild(guild_id)):
         return db_guild.max_message_length
 
     return 350
@@ -508,6 +646,7 @@ def post():
     file = getattr(request.files.get("file"), "filename", None) or None
     rich_embed = json.loads(request.form.get("richembed", "{}"))
 
+    prefetch_guild_lookups(guild_id, session.get("user_id"))
     db_user = (
         bot_http_client.get_guild_member(guild_id, session["user_id"])
         if "user_id" in session
@@ -701,12 +840,7 @@ def change_unauthenticated_username():
 
 
 def get_guild_guest_icon(guild_id):
-    guest_icon = (
-        db.session.query(Guilds)
-        .filter(Guilds.guild_id == guild_id)
-        .first()
-        .guest_icon
-    )
+    guest_icon = get_db_guild(guild_id).guest_icon
     return (
         guest_icon
         if guest_icon
@@ -792,10 +926,31 @@ def server_members_visitor():
     return jsonify(query_server_members(guild_id))
 
 
-def query_server_members(guild_id):
+def fetch_widget_snapshot(guild_id):
     widget = discord_api.get_widget(guild_id)
-    if widget.get("success", True):
-        discordmembers = get_online_discord_users(guild_id, widget)
+    if not widget.get("success", True):
+        return {"widgetenabled": False}
+
+    return {
+        "widgetenabled": True,
+        "discordmembers": get_online_discord_users(guild_id, widget),
+    }
+
+
+def get_widget_snapshot(guild_id):
+    return get_shared_snapshot(
+        f"WidgetSnapshot/{guild_id}",
+        redis_cache.WIDGET_TTL,
+        redis_cache.WIDGET_STALE_TTL,
+        fetch_widget_snapshot,
+        guild_id,
+    )
+
+
+def query_server_members(guild_id):
+    widget = get_widget_snapshot(guild_id)
+    if widget["widgetenabled"]:
+        discordmembers = widget["discordmembers"]
         widgetenabled = True
     else:
         discordmembers = [
@@ -887,10 +1042,15 @@ def user_info(guild_id, user_id):
             usr["id"], usr["avatar"], usr["discriminator"], True
         )
 
-        roles = get_member_roles(guild_id, user_id)
-        guild_roles = bot_http_client.get_guild(guild_id)["roles"]
+        guild = bot_http_client.get_guild(guild_id)
+        role_index = get_guild_role_index(guild)
         usr["roles"] = [
-            gr for gr in guild_roles for r in roles if gr["id"] == r
+            guild["roles"][i]
+            for i in sorted(
+                role_index[r]
+                for r in get_member_roles(guild_id, user_id)
+                if r in role_index
+            )
         ]
 
         usr["badges"] = get_badges(user_id)
@@ -983,6 +1143,7 @@ def bot_ban():
     )
     db.session.add(db_ban)
     db.session.commit()
+    invalidate_guest_statuses(guild_id, db_user.ip_address)
 
     return jsonify(
         success=f"Guest user, **{db_ban.last_username}#{db_ban.last_discriminator}**, has successfully been added to the ban list!"
@@ -1064,6 +1225,9 @@ def bot_revoke():
 
     dbuser.revoked = True
     db.session.commit()
+    redis_cache.delete_user_statuses(
+        guild_id, "UnauthenticatedUsers", [dbuser.user_key]
+    )
     return jsonify(
         success=f"Successfully kicked **{dbuser.username}#{dbuser.discriminator}**!"
     )
@@ -19,10 +19,11 @@ from flask import (
 )
 from flask_babel import gettext
 from titanembeds import bot_http_client
-from titanembeds.database import Guilds, UserCSS, db, list_disabled_guilds
-from titanembeds.redis_cache import get_online_embed_user_keys
+from titanembeds.database import UserCSS, db, is_guild_disabled
+from titanembeds.redis_cache import count_online_embed_users
 from titanembeds.utils import (
     generate_guild_icon_url,
+    get_db_guild,
     guild_accepts_visitors,
     guild_query_unauth_users_bool,
     guild_unauthcaptcha_enabled,
@@ -88,10 +89,7 @@ def parse_url_domain(url):
 
 
 def is_peak(guild_id):
-    usrs = get_online_embed_user_keys(guild_id)
-    return (
-        len(usrs["AuthenticatedUsers"]) + len(usrs["UnauthenticatedUsers"])
-    ) > 10
+    return sum(count_online_embed_users(guild_id).values()) > 10
 
 
 @embed.route("/<int:guild_id>")
@@ -101,9 +99,7 @@ def guild_embed(guild_id):
         abort(404)
 
     try:
-        db_guild = (
-            db.session.query(Guilds).filter(Guilds.guild_id == guild_id).first()
-        )
+        db_guild = get_db_guild(guild_id)
     except sqlalchemy.exc.OperationalError:
         # we sometimes loose connection with the database and have to reconnect
         # This seems to be the first db query we hit when loading the embed
@@ -114,9 +110,7 @@ def guild_embed(guild_id):
         # sqlalchemy.exc.PendingRollbackError: Can't reconnect until invalid transaction is rolled back.
         # (Background on this error at: https://sqlalche.me/e/14/8s2b)
         db.session.begin()
-        db_guild = (
-            db.session.query(Guilds).filter(Guilds.guild_id == guild_id).first()
-        )
+        db_guild = get_db_guild(guild_id)
         log.info("Reconnected to db")
 
     if not db_guild:
@@ -137,7 +131,7 @@ def guild_embed(guild_id):
 
     return render_template(
         "embed.html.j2",
-        disabled=str(guild_id) in list_disabled_guilds(),
+        disabled=is_guild_disabled(guild_id),
         login_greeting=get_logingreeting(),
         guild_id=guild_id,
         guild=guild_dict,
@@ -4,18 +4,24 @@ import logging
 
 from flask import session
 from flask_socketio import Namespace, disconnect, emit, join_room, leave_room
-from titanembeds import bot_http_client, redis_cache
-from titanembeds.cache_keys import get_client_ipaddr
-from titanembeds.database import db
+from limits import parse
+from titanembeds import bot_http_client, rate_limiter, redis_cache
+from titanembeds.cache_keys import generate_session_key, get_client_ipaddr
+from titanembeds.database import db, is_guild_disabled
 from titanembeds.discord_rest import discord_api
 from titanembeds.utils import (
     check_user_in_guild,
     get_forced_role,
+    get_guild_channel,
     get_guild_channels,
+    get_guild_role,
     guild_accepts_visitors,
     guild_webhooks_enabled,
+    heartbeat_user_status,
+    int_or_none,
     serializer,
     update_user_status,
+    user_unauthenticated,
 )
 from functools import wraps
 
@@ -23,13 +29,17 @@ DISCORDAPP_AVATARS_URL = "https://cdn.discordapp.com/avatars/"
 
 log = logging.getLogger(__name__)
 
+# the limit of /api/fetch, which subscribe_channel stands in for
+SUBSCRIBE_CHANNEL_LIMIT = parse("2 per 2 second")
+
 
 def teardown_db_session(func):
     @wraps(func)
     def wrapped(*args, **kwargs):
-        func(*args, **kwargs)
+        result = func(*args, **kwargs)
         db.session.commit()
         db.session.remove()
+        return result
 
     return wrapped
 
@@ -164,7 +174,7 @@ class Gateway(Namespace):
             if session["unauthenticated"]:
                 key = session["user_keys"][guild_id]
 
-            status = update_user_status(guild_id, session["username"], key)
+            status = heartbeat_user_status(guild_id, session["username"], key)
             if status["revoked"] or status["banned"]:
                 emit("revoke")
                 time.sleep(1)
@@ -200,6 +210,66 @@ class Gateway(Namespace):
 
         emit("channel_list", channels)
 
+    @teardown_db_session
+    @check_guild_in_session
+    def on_subscribe_channel(self, data):
+        # acks with the messages like /api/fetch and keeps the socket in the
+        # channel's room for later messages
+        guild_id = data["guild_id"]
+        channel_id = data["channel_id"]
+        after_snowflake = int_or_none(data.get("after")) or 0
+        visitor_mode = data.get("visitor_mode", False)
+        status = None
+
+        if is_guild_disabled(guild_id):
+            return {"code": 423}
+        # bucketed per session and channel, like channel_ratelimit_key
+        if not rate_limiter.limiter.hit(
+            SUBSCRIBE_CHANNEL_LIMIT,
+            "subscribe_channel",
+            generate_session_key() + str(channel_id),
+        ):
+            return {"code": 429}
+
+        if visitor_mode:
+            if not guild_accepts_visitors(guild_id):
+                return {"code": 403}
+        else:
+            if "username" not in session:
+                return {"code": 401}
+
+            key = None
+            if user_unauthenticated():
+                key = session.get("user_keys", {}).get(guild_id)
+            status = update_user_status(guild_id, session["username"], key)
+            if status["banned"] or status["revoked"]:
+                # like /api/fetch, and stop pushing an earlier subscription
+                if user_unauthenticated():
+                    session["user_keys"].pop(guild_id, None)
+                    session.modified = True
+                leave_room("CHANNEL_" + str(channel_id))
+                return {"code": 403, "status": status}
+
+        chan = get_guild_channel(
+            guild_id,
+            channel_id,
+            visitor_mode,
+            get_forced_role(guild_id),
+        )
+        if not chan:
+            return {"code": 404, "status": status}
+        if not chan["read"] or chan["channel"]["type"] != "text":
+            return {"code": 401, "status": status}
+
+        join_room("CHANNEL_" + chan["channel"]["id"])
+        return {
+            "code": 200,
+            "status": status,
+            "messages": bot_http_client.get_channel_messages(
+                guild_id, channel_id, after_snowflake
+            ),
+        }
+
     @teardown_db_session
     @check_guild_in_session
     def on_current_user_info(self, data):
@@ -222,10 +292,9 @@ class Gateway(Namespace):
             return None
 
         # get the role objects from id's in member["roles"]
-        guild_roles = bot_http_client.get_guild(guild_id)["roles"]
-        roles_map = {str(role["id"]): role for role in guild_roles}
+        guild = bot_http_client.get_guild(guild_id)
         roles = [
-            r for r_id in member["roles"] if (r := roles_map.get(str(r_id)))
+            r for r_id in member["roles"] if (r := get_guild_role(guild, r_id))
         ]
 
         color = None
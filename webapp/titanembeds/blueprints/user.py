@@ -13,7 +13,7 @@ from flask import (
     url_for,
 )
 from flask_socketio import emit
-from titanembeds import bot_http_client
+from titanembeds import bot_http_client, redis_cache
 from titanembeds.database import (
     Cosmetics,
     Guilds,
@@ -22,7 +22,8 @@ from titanembeds.database import (
     UserCSS,
     db,
     get_titan_token,
-    list_disabled_guilds,
+    invalidate_guild_settings,
+    is_guild_disabled,
 )
 from titanembeds.decorators import discord_users_only
 from titanembeds.discord_rest.oauth import (
@@ -42,6 +43,7 @@ from titanembeds.utils import (
     generate_avatar_url,
     generate_bot_invite_url,
     generate_guild_icon_url,
+    invalidate_guest_statuses,
 )
 
 log = logging.getLogger(__name__)
@@ -377,14 +379,14 @@ def administrate_guild(guild_id):
         members=users,
         permissions=permissions,
         cosmetics=cosmetics,
-        disabled=(guild_id in list_disabled_guilds()),
+        disabled=is_guild_disabled(guild_id),
     )
 
 
 @user_bp.route("/administrate_guild/<guild_id>", methods=["POST"])
 @discord_users_only()
 def update_administrate_guild(guild_id):
-    if guild_id in list_disabled_guilds():
+    if is_guild_disabled(guild_id):
         return "", 423
     if not check_user_can_administrate_guild(guild_id):
         abort(403)
@@ -471,6 +473,7 @@ def update_administrate_guild(guild_id):
         db_guild.banned_words = json.dumps(list(banned_words))
 
     db.session.commit()
+    invalidate_guild_settings(guild_id)
     emit(
         "guest_icon_change",
         {
@@ -565,7 +568,7 @@ def ban_unauthenticated_user():
     user_id = request.form.get("user_id", None)
     reason = request.form.get("reason", None)
 
-    if guild_id in list_disabled_guilds():
+    if is_guild_disabled(guild_id):
         return "", 423
 
     if reason is not None:
@@ -613,6 +616,7 @@ def ban_unauthenticated_user():
     )
     db.session.add(db_ban)
     db.session.commit()
+    invalidate_guest_statuses(guild_id, db_user.ip_address)
 
     return "", 204
 
@@ -623,7 +627,7 @@ def unban_unauthenticated_user():
     guild_id = request.args.get("guild_id", None)
     user_id = request.args.get("user_id", None)
 
-    if guild_id in list_disabled_guilds():
+    if is_guild_disabled(guild_id):
         return "", 423
     if not guild_id or not user_id:
         abort(400)
@@ -667,7 +671,7 @@ def revoke_unauthenticated_user():
     guild_id = request.form.get("guild_id", None)
     user_id = request.form.get("user_id", None)
 
-    if guild_id in list_disabled_guilds():
+    if is_guild_disabled(guild_id):
         return "", 423
     if not guild_id or not user_id:
         abort(400)
@@ -690,5 +694,8 @@ def revoke_unauthenticated_user():
 
     db_user.revokeUser()
     db.session.commit()
+    redis_cache.delete_user_statuses(
+        guild_id, "UnauthenticatedUsers", [db_user.user_key]
+    )
 
     return "", 204
@@ -1,12 +1,58 @@
+import json
+import time
 import socket
 import logging
+from collections import Counter
 
 import requests
 from config import config
-from requests.exceptions import ConnectionError
+from redis.exceptions import RedisError
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, RequestException, Timeout
+from titanembeds import redis_cache
+from titanembeds.request_cache import remember, request_memoize
+from titanembeds.single_flight import single_flight
+from urllib3.util.retry import Retry
 
 log = logging.getLogger(__name__)
 
+# hit/miss counts for the redis keys the bot writes, per resource
+cache_stats = Counter()
+
+# user ids sent per request to the bot's member_batch endpoint
+MEMBER_BATCH_SIZE = 100
+# members fetched per request from the bot's member_list endpoint
+MEMBER_LIST_PAGE_SIZE = 1000
+
+# (base url, expiry timestamp) of the last address resolution of the bot
+_url_cache = (None, 0)
+
+
+def make_session():
+    # read timeouts are raised straight away rather than retried, a hung bot
+    # would hold the request for several read timeouts. The last 5xx
+    # response is returned rather than raised once the retries run out.
+    retries = Retry(
+        total=config["bot-http-retries"],
+        read=False,
+        backoff_factor=config["bot-http-retry-backoff"],
+        status_forcelist=[502, 503, 504],
+        allowed_methods=["GET"],
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=config["bot-http-pool-size"],
+        max_retries=retries,
+    )
+
+    session = requests.Session()
+    session.mount("http://", adapter)
+    return session
+
+
+session = make_session()
+
 
 # old_getaddrinfo = socket.getaddrinfo
 #
@@ -33,6 +79,24 @@ def get_url():
         return f'http://{config["bot-http-url"]}:{config["bot-http-port"]}'
 
 
+def get_cached_url():
+    global _url_cache
+
+    url, expires = _url_cache
+    if url and expires > time.time():
+        return url
+
+    url = get_url()
+    if url:
+        _url_cache = (url, time.time() + config["bot-http-addr-ttl"])
+    return url
+
+
+def invalidate_cached_url():
+    global _url_cache
+    _url_cache = (None, 0)
+
+
 def get_ipv6_addr(host, port):
     log.info("looking up %s:%s", host, port)
     addrs = socket.getaddrinfo(host, port)
@@ -45,28 +109,135 @@ def get_ipv6_addr(host, port):
 
 
 def http_get(path):
-    url = f"{get_url()}/{path}"
+    url = f"{get_cached_url()}/{path}"
     log.info("GET %s", url)
 
     try:
-        response = requests.get(url)
+        # concurrent requests for the same resource share one call to the
+        # bot, each parses the response into objects of its own
+        response = single_flight(
+            url,
+            session.get,
+            url,
+            timeout=(
+                config["bot-http-connect-timeout"],
+                config["bot-http-read-timeout"],
+            ),
+        )
     except ConnectionError:
         log.error("Could not connect to %s", url)
+        # the bot may have moved, look its address up again next time
+        invalidate_cached_url()
+        return None
+    except Timeout:
+        log.error("Timed out waiting for %s", url)
+        return None
+    except RequestException:
+        log.exception("Request to %s failed", url)
+        return None
+
+    if response.status_code >= 500:
+        log.error("%s answered %s", url, response.status_code)
         return None
 
     try:
-        json = response.json()
+        content = response.json()
     except requests.exceptions.JSONDecodeError:
         log.error("No valid json in response")
         return None
 
-    log.info("response:\n%s", json)
-    return json
+    log.info("response:\n%s", content)
+    return content
+
 
+def record_cache_lookup(resource, hit):
+    cache_stats[f"{resource}.{'hits' if hit else 'misses'}"] += 1
 
-def get_channel_messages(guild_id, channel_id, after_snowflake=0):
+
+def get_cache_stats():
+    return dict(cache_stats)
+
+
+def cache_get(resource, key):
+    # the bot stores an empty string for members it could not find, returned as
+    # {} like the http api
+    try:
+        value = redis_cache.redis_store.get(key)
+    except RedisError:
+        log.exception("Could not read %s from redis", key)
+        value = None
+
+    record_cache_lookup(resource, value is not None)
+    if value is None:
+        return None
+
+    return json.loads(value) if value else {}
+
+
+def cache_get_set(resource, key):
+    try:
+        members = redis_cache.redis_store.smembers(key)
+    except RedisError:
+        log.exception("Could not read %s from redis", key)
+        members = None
+
+    record_cache_lookup(resource, bool(members))
+    if not members:
+        return None
+
+    return [json.loads(m) for m in members if m]
+
+
+def cache_get_channel_messages(channel_id, after_snowflake=0, limit=50):
+    # see the bot's redis_cache module for the key layout
+    index_key = f"Queue/channels/{channel_id}/message_ids"
+    payload_key = f"Queue/channels/{channel_id}/message_payloads"
+    backfill_key = f"Queue/channels/{channel_id}/message_backfill"
+    after_snowflake = int(after_snowflake)
+
+    try:
+        pipe = redis_cache.redis_store.pipeline(transaction=False)
+        pipe.exists(index_key)
+        # the bot is still reading the channel from discord
+        pipe.exists(backfill_key)
+        pipe.zrevrangebyscore(
+            index_key, "+inf", after_snowflake >> 22, start=0, num=limit + 1
+        )
+        exists, backfilling, message_ids = pipe.execute()
+        exists = exists and not backfilling
+
+        message_ids = [
+            m for m in message_ids if m != "0" and int(m) > after_snowflake
+        ][:limit]
+        payloads = (
+            redis_cache.redis_store.hmget(payload_key, message_ids)
+            if exists and message_ids
+            else []
+        )
+    except RedisError:
+        log.exception(
+            "Could not read channel %s messages from redis", channel_id
+        )
+        exists = False
+
+    record_cache_lookup("channel_messages", bool(exists))
+    if not exists:
+        return None
+
+    return [json.loads(p) for p in payloads if p]
+
+
+def get_channel_messages(
+    guild_id, channel_id, after_snowflake=0, none_if_unavailable=False
+):
     log.info("get_channel_messages")
-    response = http_get(f"channel_messages/{channel_id}")
+    response = None
+    if config["message-cache-authoritative"]:
+        response = cache_get_channel_messages(channel_id, after_snowflake)
+    if response is None:
+        response = http_get(f"channel_messages/{channel_id}")
+    if response is None and none_if_unavailable:
+        return None
     channel_messages = response if response else []
 
     if not channel_messages:
@@ -76,7 +247,6 @@ def get_channel_messages(guild_id, channel_id, after_snowflake=0):
 
     msgs = []
     snowflakes = []
-    guild_members = {}
 
     for channel_message in channel_messages:
         if channel_message["id"] in snowflakes or int(
@@ -99,14 +269,21 @@ def get_channel_messages(guild_id, channel_id, after_snowflake=0):
             "reactions": channel_message["reactions"],
             "type": channel_message.get("type", 0),
         }
+        msgs.append(message)
 
-        if message["author"]["id"] not in guild_members:
-            member = get_guild_member(guild_id, message["author"]["id"])
-            guild_members[message["author"]["id"]] = member
-        else:
-            member = guild_members[message["author"]["id"]]
-
-        if member:
+    sorted_msgs = sorted(msgs, key=lambda k: k["id"], reverse=True)
+    # only return last 50 messages in cache please
+    sorted_msgs = sorted_msgs[:50]
+
+    # resolve every author and mention of the page in one go
+    guild_members = get_guild_members(
+        guild_id,
+        [m["author"]["id"] for m in sorted_msgs]
+        + [mention["id"] for m in sorted_msgs for mention in m["mentions"]],
+    )
+
+    for message in sorted_msgs:
+        if member := guild_members.get(str(message["author"]["id"])):
             message["author"]["nickname"] = member["nick"]
             message["author"]["avatar"] = member["avatar"]
             message["author"]["discriminator"] = member["discriminator"]
@@ -115,13 +292,7 @@ def get_channel_messages(guild_id, channel_id, after_snowflake=0):
             message["author"]["nickname"] = None
 
         for mention in message["mentions"]:
-            if mention["id"] not in guild_members:
-                author = get_guild_member(guild_id, mention["id"])
-                guild_members[mention["id"]] = author
-            else:
-                author = guild_members[mention["id"]]
-
-            if author:
+            if author := guild_members.get(str(mention["id"])):
                 mention["nickname"] = author["nick"]
                 mention["avatar"] = author["avatar"]
                 mention["username"] = author["username"]
@@ -129,17 +300,72 @@ def get_channel_messages(guild_id, channel_id, after_snowflake=0):
             else:
                 mention["nickname"] = None
 
-        msgs.append(message)
-
-    sorted_msgs = sorted(msgs, key=lambda k: k["id"], reverse=True)
     log.info("get_channel_messages finished")
-    return sorted_msgs[:50]  # only return last 50 messages in cache please
+    return sorted_msgs
 
 
+@request_memoize("guild_member")
 def get_guild_member(guild_id, user_id):
+    member = cache_get(
+        "guild_member", f"Queue/guilds/{guild_id}/members/{user_id}"
+    )
+    if member is not None:
+        return member
+
     return http_get(f"guild/{guild_id}/member/{user_id}")
 
 
+def get_cached_guild_members(guild_id, user_ids):
+    # returns the cache hits by user id and the ids that missed
+    user_ids = list(dict.fromkeys(str(user_id) for user_id in user_ids))
+    if not user_ids:
+        return {}, []
+
+    try:
+        cached = redis_cache.redis_store.mget(
+            [f"Queue/guilds/{guild_id}/members/{u}" for u in user_ids]
+        )
+    except RedisError:
+        log.exception("Could not read guild %s members from redis", guild_id)
+        cached = [None] * len(user_ids)
+
+    members = {}
+    missing = []
+    for user_id, value in zip(user_ids, cached):
+        record_cache_lookup("guild_member", value is not None)
+        if value is None:
+            missing.append(user_id)
+        else:
+            members[user_id] = json.loads(value) if value else {}
+
+    return members, missing
+
+
+def fetch_guild_members(guild_id, user_ids):
+    # skips redis
+    members = {}
+    for i in range(0, len(user_ids), MEMBER_BATCH_SIZE):
+        user_ids_param = ",".join(user_ids[i : i + MEMBER_BATCH_SIZE])
+        members.update(
+            http_get(f"guild/{guild_id}/member_batch?user_ids={user_ids_param}")
+            or {}
+        )
+
+    return members
+
+
+def get_guild_members(guild_id, user_ids):
+    # one MGET and a bot request per 100 misses; members that could not be found
+    # map to {}
+    members, missing = get_cached_guild_members(guild_id, user_ids)
+    members.update(fetch_guild_members(guild_id, missing))
+
+    for user_id, member in members.items():
+        remember("guild_member", guild_id, user_id, value=member)
+
+    return members
+
+
 def get_guild_member_named(guild_id, query):
     guild_member_id = http_get(f"guild/{guild_id}/member-name/{query}")
 
@@ -150,25 +376,49 @@ def get_guild_member_named(guild_id, query):
 
 
 def list_guild_members(guild_id):
-    member_ids = http_get(f"guild/{guild_id}/members")
-    if not member_ids:
-        return []
+    member_ids = cache_get_set(
+        "guild_members", f"Queue/guilds/{guild_id}/members"
+    )
+    if member_ids is not None:
+        members, missing = get_cached_guild_members(
+            guild_id, [m["user_id"] for m in member_ids]
+        )
+        # only go through the cache if it holds nearly all of the members
+        if len(missing) <= MEMBER_BATCH_SIZE:
+            members.update(fetch_guild_members(guild_id, missing))
+            return [m for m in members.values() if m]
+
+    members = []
+    offset = 0
+    while offset is not None:
+        page = http_get(
+            f"guild/{guild_id}/member_list"
+            f"?offset={offset}&limit={MEMBER_LIST_PAGE_SIZE}"
+        )
+        if not page:
+            break
+
+        members.extend(page["members"])
+        offset = page["next_offset"]
 
-    return [
-        m
-        for m_id in member_ids
-        if (m := get_guild_member(guild_id, m_id["user_id"]))
-    ]
+    return members
 
 
+@request_memoize("guild")
 def get_guild(guild_id):
     try:
         guild_id = int(guild_id)
     except (TypeError, ValueError):
         return None
 
+    if (guild := cache_get("guild", f"Queue/guilds/{guild_id}")) is not None:
+        return guild
+
     return http_get(f"guild/{guild_id}")
 
 
 def get_user(user_id):
+    if (user := cache_get("user", f"Queue/users/{user_id}")) is not None:
+        return user
+
     return http_get(f"user/{user_id}")
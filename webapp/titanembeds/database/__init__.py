@@ -3,12 +3,21 @@ from flask_sqlalchemy import SQLAlchemy
 db = SQLAlchemy()
 
 from .administrators import Administrators, get_administrators_list
-from .application_settings import ApplicationSettings
+from .application_settings import (
+    ApplicationSettings,
+    get_application_settings,
+    invalidate_application_settings,
+)
 from .authenticated_users import AuthenticatedUsers
 from .cosmetics import Cosmetics, add_badge, get_badges, remove_badge, set_badges
-from .disabled_guilds import DisabledGuilds, list_disabled_guilds
+from .disabled_guilds import (
+    DisabledGuilds,
+    invalidate_disabled_guilds,
+    is_guild_disabled,
+    list_disabled_guilds,
+)
 from .discordbotsorg_transactions import DiscordBotsOrgTransactions
-from .guilds import Guilds
+from .guilds import Guilds, get_guild_settings, invalidate_guild_settings
 
 # from .patreon import Patreon
 from .titan_tokens import TitanTokens, get_titan_token
@@ -50,7 +59,3 @@ def init_application_settings():
         settings = ApplicationSettings()
         db.session.add(settings)
         db.session.commit()
-
-
-def get_application_settings():
-    return db.session.query(ApplicationSettings).first()
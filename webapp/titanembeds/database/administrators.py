@@ -1,4 +1,10 @@
 from titanembeds.database import db
+from titanembeds.local_cache import TTLCache
+
+# read for every template render and admin page request. Administrators are
+# only ever changed in the database by hand, so the ttl is all that bounds
+# how long a change takes to show.
+administrators_cache = TTLCache("administrators", maxsize=1, ttl=60)
 
 
 class Administrators(db.Model):
@@ -8,8 +14,8 @@ class Administrators(db.Model):
 
 
 def get_administrators_list():
-    q = db.session.query(Administrators).all()
-    their_ids = []
-    for admin in q:
-        their_ids.append(str(admin.user_id))
-    return their_ids
+    def load():
+        q = db.session.query(Administrators.user_id).all()
+        return frozenset(str(admin.user_id) for admin in q)
+
+    return administrators_cache.get_or_load("all", load)
@@ -1,4 +1,10 @@
+from types import SimpleNamespace
+
 from titanembeds.database import db
+from titanembeds.local_cache import TTLCache, publish_invalidation
+
+# read for every template render, changed only from the admin page
+application_settings_cache = TTLCache("application_settings", maxsize=1, ttl=60)
 
 
 class ApplicationSettings(db.Model):
@@ -22,3 +28,23 @@ class ApplicationSettings(db.Model):
         self.donation_goal_progress = 0
         self.donation_goal_total = 0
         self.donation_goal_end = None
+
+
+def get_application_settings():
+    # read only snapshot
+    def load():
+        if not (settings := db.session.query(ApplicationSettings).first()):
+            return None
+
+        return SimpleNamespace(
+            **{
+                c.name: getattr(settings, c.name)
+                for c in ApplicationSettings.__table__.columns
+            }
+        )
+
+    return application_settings_cache.get_or_load("all", load)
+
+
+def invalidate_application_settings():
+    publish_invalidation(application_settings_cache.name)
@@ -1,4 +1,8 @@
 from titanembeds.database import db
+from titanembeds.local_cache import TTLCache, publish_invalidation
+
+# checked on every api call and embed render, changed only from the admin page
+disabled_guilds_cache = TTLCache("disabled_guilds", maxsize=1, ttl=300)
 
 
 class DisabledGuilds(db.Model):
@@ -10,9 +14,21 @@ class DisabledGuilds(db.Model):
         self.guild_id = guild_id
 
 
+def get_disabled_guild_ids():
+    def load():
+        q = db.session.query(DisabledGuilds.guild_id).all()
+        return frozenset(str(guild.guild_id) for guild in q)
+
+    return disabled_guilds_cache.get_or_load("all", load)
+
+
 def list_disabled_guilds():
-    q = db.session.query(DisabledGuilds).all()
-    their_ids = []
-    for guild in q:
-        their_ids.append(str(guild.guild_id))
-    return their_ids
+    return sorted(get_disabled_guild_ids())
+
+
+def is_guild_disabled(guild_id):
+    return str(guild_id) in get_disabled_guild_ids()
+
+
+def invalidate_disabled_guilds():
+    publish_invalidation(disabled_guilds_cache.name)
@@ -1,4 +1,11 @@
+from types import SimpleNamespace
+
 from titanembeds.database import db
+from titanembeds.local_cache import TTLCache, publish_invalidation
+
+# guild settings are read on nearly every request but only change when they
+# are saved from the dashboard, which invalidates them in every worker
+guild_settings_cache = TTLCache("guild_settings", maxsize=2048, ttl=60)
 
 
 class Guilds(db.Model):
@@ -72,3 +79,21 @@ class Guilds(db.Model):
     def set_unauthUsersBool(self, value):
         self.unauth_users = value
         return self.unauth_users
+
+
+def get_guild_settings(guild_id):
+    # read only snapshot, None if the guild has no settings yet
+    def load():
+        guild = db.session.query(Guilds).filter(Guilds.guild_id == guild_id)
+        if not (guild := guild.first()):
+            return None
+
+        return SimpleNamespace(
+            **{c.name: getattr(guild, c.name) for c in Guilds.__table__.columns}
+        )
+
+    return guild_settings_cache.get_or_load(str(guild_id), load)
+
+
+def invalidate_guild_settings(guild_id):
+    publish_invalidation(guild_settings_cache.name, str(guild_id))
@@ -1,7 +1,7 @@
 from functools import wraps
 
 from flask import jsonify, redirect, request, session, url_for
-from titanembeds.database import list_disabled_guilds
+from titanembeds.database import is_guild_disabled
 
 
 def valid_session_required(api=False):
@@ -60,7 +60,7 @@ def abort_if_guild_disabled(*args):
             if not guild_id and len(args) > 0:
                 guild_id = args[0]
 
-            if guild_id in list_disabled_guilds():
+            if is_guild_disabled(guild_id):
                 return "", 423
 
             return f(*args, **kwargs)
@@ -0,0 +1,101 @@
+import json
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+from titanembeds import redis_cache
+
+log = logging.getLogger(__name__)
+
+INVALIDATION_CHANNEL = "titan/cache-invalidate"
+
+# name -> TTLCache, for invalidations published by other workers
+caches = {}
+
+
+class TTLCache:
+    """In process LRU cache whose entries expire after `ttl` seconds.
+
+    Every cache is registered under its `name` so that it can be invalidated
+    from other worker processes with `publish_invalidation`.
+    """
+
+    def __init__(self, name, maxsize, ttl):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        caches[name] = self
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is None:
+                return default
+
+            value, expires = entry
+            if expires < time.monotonic():
+                del self.data[key]
+                return default
+
+            self.data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.data[key] = (value, time.monotonic() + self.ttl)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def get_or_load(self, key, loader):
+        # None results are not cached
+        value = self.get(key)
+        if value is None:
+            value = loader()
+            if value is not None:
+                self.set(key, value)
+        return value
+
+    def invalidate(self, key=None):
+        with self.lock:
+            if key is None:
+                self.data.clear()
+            else:
+                self.data.pop(key, None)
+
+
+def publish_invalidation(name, key=None):
+    caches[name].invalidate(key)
+    redis_cache.redis_store.publish(
+        INVALIDATION_CHANNEL, json.dumps({"cache": name, "key": key})
+    )
+
+
+def on_invalidation_message(message):
+    try:
+        data = json.loads(message["data"])
+    except (TypeError, ValueError):
+        log.error("Invalid cache invalidation message: %s", message)
+        return
+
+    if cache := caches.get(data.get("cache")):
+        cache.invalidate(data.get("key"))
+
+
+def on_listener_error(error, pubsub, thread):
+    # invalidations may have been missed while disconnected
+    log.error("Cache invalidation listener error: %s", error)
+    for cache in caches.values():
+        cache.invalidate()
+    time.sleep(1)
+
+
+def init_invalidation_listener():
+    pubsub = redis_cache.redis_store.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(**{INVALIDATION_CHANNEL: on_invalidation_message})
+    return pubsub.run_in_thread(
+        sleep_time=1, daemon=True, exception_handler=on_listener_error
+    )
@@ -1,32 +1,214 @@
+import json
+import time
+
 from redis import Redis
 
 redis_store = Redis()
+bump_presence_script = None
+touch_user_status_script = None
+cache_rendered_messages_script = None
+
+# seconds an embed user stays online after their last heartbeat or fetch
+PRESENCE_TTL = 60
+# seconds a user's embed status is reused by gateway heartbeats, bans and
+# revokes delete it straight away
+USER_STATUS_TTL = 60 * 5
+# seconds a guild's online embed users and widget snapshot are fresh, and
+# kept to be served stale while a single worker refreshes them
+ONLINE_USERS_TTL = 5
+ONLINE_USERS_STALE_TTL = 60
+WIDGET_TTL = 30
+WIDGET_STALE_TTL = 60 * 5
+# seconds the rendered visitor messages of a channel are kept, the bot
+# drops them as soon as a message of the channel changes
+RENDERED_MESSAGES_TTL = 30
+
+USER_TYPES = ["AuthenticatedUsers", "UnauthenticatedUsers"]
+
+# Embed users that are online are kept in sorted sets scored by the time
+# they were last seen:
+#   MemberPresence/{guild_id}/{user_type} - client keys (user key or id)
+#   MemberPresence/all/{user_type} - "{guild_id}/{client key}" of all guilds
+# Users not seen for PRESENCE_TTL seconds are pruned on every bump.
+
+# KEYS: guild presence, all guilds presence
+# ARGV: now, client key, "{guild id}/{client key}", presence ttl
+BUMP_PRESENCE_LUA = """
+local cutoff = tonumber(ARGV[1]) - tonumber(ARGV[4])
+redis.call("ZADD", KEYS[1], ARGV[1], ARGV[2])
+redis.call("ZREMRANGEBYSCORE", KEYS[1], "-inf", cutoff)
+redis.call("EXPIRE", KEYS[1], ARGV[4])
+redis.call("ZADD", KEYS[2], ARGV[1], ARGV[3])
+redis.call("ZREMRANGEBYSCORE", KEYS[2], "-inf", cutoff)
+"""
+
+# KEYS: guild presence, all guilds presence, user status
+# ARGV: as BUMP_PRESENCE_LUA
+TOUCH_USER_STATUS_LUA = f"""
+local status = redis.call("GET", KEYS[3])
+if status then
+{BUMP_PRESENCE_LUA}
+end
+return status
+"""
+
+# Rendered fetch_visitor messages, as json, are kept in a hash per channel:
+#   Queue/channels/{channel_id}/rendered_messages - "after" snowflake to json
+#   Queue/channels/{channel_id}/rendered_generation - bumped by the bot every
+#       time it drops the hash
+# Messages are only stored if the generation is still the one read before
+# they were fetched, so a change the bot saw meanwhile isn't hidden. The ttl
+# is set when the hash is created, so that entries are not kept alive by
+# traffic beyond RENDERED_MESSAGES_TTL.
+
+# KEYS: rendered messages, rendered generation
+# ARGV: after snowflake, messages json, ttl, generation read before fetching
+CACHE_RENDERED_MESSAGES_LUA = """
+if (redis.call("GET", KEYS[2]) or "") ~= ARGV[4] then
+    return 0
+end
+redis.call("HSET", KEYS[1], ARGV[1], ARGV[2])
+if redis.call("TTL", KEYS[1]) < 0 then
+    redis.call("EXPIRE", KEYS[1], ARGV[3])
+end
+return 1
+"""
 
 
 def init_redis(url):
-    global redis_store
+    global redis_store, bump_presence_script, touch_user_status_script
+    global cache_rendered_messages_script
     redis_store = Redis.from_url(url, decode_responses=True)
+    bump_presence_script = redis_store.register_script(BUMP_PRESENCE_LUA)
+    touch_user_status_script = redis_store.register_script(
+        TOUCH_USER_STATUS_LUA
+    )
+    cache_rendered_messages_script = redis_store.register_script(
+        CACHE_RENDERED_MESSAGES_LUA
+    )
+
+
+def presence_keys(guild_id, user_type):
+    return [
+        f"MemberPresence/{guild_id}/{user_type}",
+        f"MemberPresence/all/{user_type}",
+    ]
+
+
+def presence_args(guild_id, client_key):
+    return [time.time(), client_key, f"{guild_id}/{client_key}", PRESENCE_TTL]
 
 
 def bump_user_presence_timestamp(guild_id, user_type, client_key):
-    redis_key = f"MemberPresence/{guild_id}/{user_type}/{client_key}"
-    redis_store.set(redis_key, "", 60)
+    bump_presence_script(
+        keys=presence_keys(guild_id, user_type),
+        args=presence_args(guild_id, client_key),
+    )
+
+
+def user_status_key(guild_id, user_type, client_key):
+    return f"UserStatus/{guild_id}/{user_type}/{client_key}"
 
 
-def get_online_embed_user_keys(guild_id="*", user_type=None):
-    user_type = (
-        [user_type]
-        if user_type
-        else ["AuthenticatedUsers", "UnauthenticatedUsers"]
+def cache_user_status(guild_id, user_type, client_key, status):
+    redis_store.set(
+        user_status_key(guild_id, user_type, client_key),
+        json.dumps(status, separators=(",", ":")),
+        USER_STATUS_TTL,
     )
 
-    return {
-        utype: [
-            k.split("/")[-1]
-            for k in redis_store.keys(f"MemberPresence/{guild_id}/{utype}/*")
-        ]
-        for utype in user_type
-    }
+
+def touch_user_status(guild_id, user_type, client_key):
+    # None, without bumping the presence, if the status is not cached
+    status = touch_user_status_script(
+        keys=[
+            *presence_keys(guild_id, user_type),
+            user_status_key(guild_id, user_type, client_key),
+        ],
+        args=presence_args(guild_id, client_key),
+    )
+    return json.loads(status) if status else None
+
+
+def delete_user_statuses(guild_id, user_type, client_keys):
+    if client_keys:
+        redis_store.delete(
+            *(user_status_key(guild_id, user_type, k) for k in client_keys)
+        )
+
+
+def get_online_embed_user_keys(guild_id, user_type=None):
+    user_types = [user_type] if user_type else USER_TYPES
+    cutoff = time.time() - PRESENCE_TTL
+
+    pipe = redis_store.pipeline(transaction=False)
+    for utype in user_types:
+        pipe.zrangebyscore(f"MemberPresence/{guild_id}/{utype}", cutoff, "+inf")
+    return dict(zip(user_types, pipe.execute()))
+
+
+def count_online_embed_users(guild_id="all"):
+    # prune users that went offline first, so the count is a ZCARD
+    cutoff = time.time() - PRESENCE_TTL
+
+    pipe = redis_store.pipeline(transaction=False)
+    for utype in USER_TYPES:
+        key = f"MemberPresence/{guild_id}/{utype}"
+        pipe.zremrangebyscore(key, "-inf", cutoff)
+        pipe.zcard(key)
+    return dict(zip(USER_TYPES, pipe.execute()[1::2]))
+
+
+def get_snapshot(key):
+    if not (snapshot := redis_store.get(key)):
+        return None
+
+    snapshot = json.loads(snapshot)
+    return snapshot["fetched"], snapshot["value"]
+
+
+def cache_snapshot(key, value, ttl):
+    redis_store.set(
+        key,
+        json.dumps(
+            {"fetched": time.time(), "value": value}, separators=(",", ":")
+        ),
+        ttl,
+    )
+
+
+def snapshot_refresh_lock(key):
+    return redis_store.lock(f"{key}/refresh", timeout=30, blocking=False)
+
+
+def rendered_messages_keys(channel_id):
+    return [
+        f"Queue/channels/{channel_id}/rendered_messages",
+        f"Queue/channels/{channel_id}/rendered_generation",
+    ]
+
+
+def get_rendered_messages(channel_id, after_snowflake):
+    # the generation is passed to cache_rendered_messages on a miss
+    rendered_key, generation_key = rendered_messages_keys(channel_id)
+
+    pipe = redis_store.pipeline(transaction=False)
+    pipe.hget(rendered_key, str(after_snowflake))
+    pipe.get(generation_key)
+    rendered, generation = pipe.execute()
+    return rendered, generation or ""
+
+
+def cache_rendered_messages(channel_id, after_snowflake, rendered, generation):
+    cache_rendered_messages_script(
+        keys=rendered_messages_keys(channel_id),
+        args=[
+            str(after_snowflake),
+            rendered,
+            RENDERED_MESSAGES_TTL,
+            generation,
+        ],
+    )
 
 
 def guild_clear_cache(guild_id):
@@ -0,0 +1,92 @@
+import logging
+from functools import wraps
+from collections import Counter
+
+from config import config
+from flask import g, has_app_context
+
+try:
+    import eventlet
+except ImportError:
+    eventlet = None
+
+log = logging.getLogger(__name__)
+
+
+class Pending:
+    def __init__(self, thread):
+        self.thread = thread
+
+
+def _cache_key(name, args):
+    # ids arrive as both ints and strings depending on the caller
+    return (name, *(str(arg) for arg in args))
+
+
+def request_memoize(name):
+    """Remember the result of the decorated lookup for the rest of the
+    current request, keyed on its positional arguments.
+
+    Outside of a request (or app) context the lookup is always run.
+    """
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args):
+            if not has_app_context():
+                return func(*args)
+
+            cache = g.setdefault("request_cache", {})
+            key = _cache_key(name, args)
+            if isinstance(pending := cache.get(key), Pending):
+                try:
+                    cache[key] = pending.thread.wait()
+                    return cache[key]
+                except Exception:
+                    log.exception("Prefetched %s lookup failed", name)
+                    del cache[key]
+            elif key in cache:
+                g.setdefault("request_cache_saved", Counter())[name] += 1
+                return cache[key]
+
+            cache[key] = func(*args)
+            return cache[key]
+
+        return wrapper
+
+    return decorator
+
+
+def can_prefetch():
+    return (
+        config["api-prefetch"]
+        and eventlet is not None
+        and eventlet.patcher.is_monkey_patched("socket")
+        and has_app_context()
+    )
+
+
+def prefetch(name, func, *args):
+    # func runs outside of the app context and must not touch the database
+    # session. Without eventlet the lookup is made on first use.
+    if not can_prefetch():
+        return
+
+    cache = g.setdefault("request_cache", {})
+    key = _cache_key(name, args)
+    if key not in cache:
+        func = getattr(func, "__wrapped__", func)
+        cache[key] = Pending(eventlet.spawn(func, *args))
+
+
+def remember(name, *args, value):
+    # for callers that resolve several lookups at once
+    if has_app_context():
+        g.setdefault("request_cache", {})[_cache_key(name, args)] = value
+
+
+def get_saved_lookups():
+    if not has_app_context():
+        return Counter()
+
+    return g.get("request_cache_saved", Counter())
@@ -0,0 +1,40 @@
+import threading
+
+
+class Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+# key -> Flight of the calls in progress in this worker
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+def single_flight(key, func, *args, **kwargs):
+    # under eventlet the threading primitives are green, so this coalesces the
+    # requests of one worker
+    with _flights_lock:
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _flights[key] = Flight()
+
+    if not leader:
+        flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    try:
+        flight.result = func(*args, **kwargs)
+        return flight.result
+    except Exception as e:
+        flight.error = e
+        raise
+    finally:
+        with _flights_lock:
+            del _flights[key]
+        flight.done.set()
@@ -194,6 +194,34 @@ function pathJoin(parts, sep){
         return funct.promise();
     }
 
+    function subscribe_channel(channel_id, after) {
+        // fetch over the gateway, which also keeps pushing the channel's new messages
+        var deferred = $.Deferred();
+        var answered = false;
+        socket.emit("subscribe_channel", {"guild_id": guild_id, "channel_id": channel_id, "after": after, "visitor_mode": visitor_mode}, function (data) {
+            answered = true;
+            if (data.code == 200) {
+                deferred.resolve(data);
+            } else {
+                deferred.reject({"status": data.code});
+            }
+        });
+        setTimeout(function () {
+            if (!answered) {
+                answered = true;
+                fetch(channel_id, after).done(deferred.resolve).fail(deferred.reject);
+            }
+        }, 10000);
+        return deferred.promise();
+    }
+
+    function fetch_messages(channel_id, after) {
+        if (socket && socket_identified) {
+            return subscribe_channel(channel_id, after);
+        }
+        return fetch(channel_id, after);
+    }
+
     function post(channel_id, content, file, richembed) {
         if (content === "") {
             content = null;
@@ -1888,10 +1916,10 @@ function pathJoin(parts, sep){
 
         if (last_message_id == null) {
             $("#chatcontent").empty();
-            fet = fetch(channel_id);
+            fet = fetch_messages(channel_id);
             jumpscroll = true;
         } else {
-            fet = fetch(channel_id, last_message_id);
+            fet = fetch_messages(channel_id, last_message_id);
             jumpscroll = false;
             if (last_message_id) {
                 jumpscroll = element_in_view($('#discordmessage_'+last_message_id).parent());
@@ -1911,7 +1939,11 @@ function pathJoin(parts, sep){
                 current_user_discord_id = status.user_id;
             }
 
-            last_message_id = fill_discord_messages(data.messages, jumpscroll);
+            // messages pushed by the gateway while this was loading are already shown
+            var messages = data.messages.filter(function (message) {
+                return !$("#discordmessage_" + message.id).length;
+            });
+            last_message_id = fill_discord_messages(messages, jumpscroll);
 
             if (!visitor_mode && status.manage_embed) {
                 $("#administrate_link").show();
@@ -2465,6 +2497,9 @@ function pathJoin(parts, sep){
             console.log('websocket identified')
             socket_identified = true;
             process_message_users_cache();
+            if (socket_error_should_refetch) { // catch up on what was missed while reconnecting
+                run_fetch_routine();
+            }
         })
 
         socket.on("disconnect", function () {
@@ -1,18 +1,20 @@
 # from raven.contrib.flask import Sentry
+import json
+import hashlib
 import logging
 
 from config import config
 from flask import session
 from itsdangerous import URLSafeSerializer
 from sqlalchemy import and_
-from titanembeds import bot_http_client
+from titanembeds import bot_http_client, redis_cache
 from titanembeds.cache_keys import get_client_ipaddr
 from titanembeds.database import (
     AuthenticatedUsers,
-    Guilds,
     UnauthenticatedBans,
     UnauthenticatedUsers,
     db,
+    get_guild_settings,
 )
 from titanembeds.discord_rest.oauth import (
     AVATAR_BASE_URL,
@@ -23,12 +25,41 @@ from titanembeds.discord_rest.user import (
     check_user_can_administrate_guild,
     user_has_permission,
 )
+from titanembeds.local_cache import TTLCache
 from titanembeds.redis_cache import bump_user_presence_timestamp
+from titanembeds.request_cache import request_memoize
 
 log = logging.getLogger(__name__)
 
 serializer = URLSafeSerializer(config["app-secret"])
 
+# (key in a channel permission result, discord permission bit) for each of
+# the flags of a channel permission table, in the order of their flag bits
+CHANNEL_PERMISSIONS = (
+    ("read", 10),
+    ("write", 11),
+    ("mention_everyone", 17),
+    ("attach_files", 15),
+    ("embed_links", 14),
+)
+WRITE = 1 << 1
+ATTACH_FILES = 1 << 3
+EMBED_LINKS = 1 << 4
+ALL_CHANNEL_PERMISSIONS = (1 << len(CHANNEL_PERMISSIONS)) - 1
+
+# both keyed on the guild's permissions version, so they never go stale
+guild_permission_index_cache = TTLCache(
+    "guild_permission_index", maxsize=1024, ttl=300
+)
+channel_permission_table_cache = TTLCache(
+    "channel_permission_tables", maxsize=8192, ttl=300
+)
+
+
+@request_memoize("db_guild")
+def get_db_guild(guild_id):
+    return get_guild_settings(guild_id)
+
 
 def check_guild_existance(guild_id):
     try:
@@ -40,14 +71,12 @@ def check_guild_existance(guild_id):
 
 
 def guild_accepts_visitors(guild_id):
-    dbGuild = Guilds.query.filter_by(guild_id=guild_id).first()
+    dbGuild = get_db_guild(guild_id)
     return dbGuild.visitor_view
 
 
 def guild_query_unauth_users_bool(guild_id):
-    dbGuild = (
-        db.session.query(Guilds).filter(Guilds.guild_id == guild_id).first()
-    )
+    dbGuild = get_db_guild(guild_id)
     return dbGuild.unauth_users
 
 
@@ -164,6 +193,48 @@ def update_user_status(guild_id, username, user_key=None):
     return status
 
 
+def heartbeat_user_status(guild_id, username, user_key=None):
+    """`update_user_status` for gateway heartbeats.
+
+    A status that is neither banned nor revoked is cached, and while it is
+    a heartbeat only costs one redis round trip. Bans, revokes and members
+    leaving the guild delete the cached status.
+    """
+    if user_unauthenticated():
+        user_type, client_key = "UnauthenticatedUsers", user_key
+        ip_address = get_client_ipaddr()
+    else:
+        user_type, client_key = "AuthenticatedUsers", str(session["user_id"])
+        ip_address = None
+
+    status = redis_cache.touch_user_status(guild_id, user_type, client_key)
+    if (
+        status
+        and status["username"] == username
+        and status.get("ip_address") == ip_address
+    ):
+        return status
+
+    status = update_user_status(guild_id, username, user_key)
+    if not status["banned"] and not status["revoked"]:
+        redis_cache.cache_user_status(guild_id, user_type, client_key, status)
+    return status
+
+
+def invalidate_guest_statuses(guild_id, ip_address):
+    user_keys = (
+        db.session.query(UnauthenticatedUsers.user_key)
+        .filter(
+            UnauthenticatedUsers.guild_id == str(guild_id),
+            UnauthenticatedUsers.ip_address == ip_address,
+        )
+        .all()
+    )
+    redis_cache.delete_user_statuses(
+        guild_id, "UnauthenticatedUsers", [u.user_key for u in user_keys]
+    )
+
+
 def check_user_in_guild(guild_id):
     if user_unauthenticated():
         log.info("checking if unauthenticated user in guild")
@@ -192,11 +263,111 @@ def get_member_roles(guild_id, user_id):
     return [str(role) for role in (q["roles"])] if q else []
 
 
-def get_guild_channels(guild_id, force_everyone=False, forced_role=0):
+def get_guild_role_index(guild):
+    # stamped by the bot, built here once per snapshot for older snapshots
+    if "role_index" not in guild:
+        guild["role_index"] = {
+            str(role["id"]): i for i, role in enumerate(guild["roles"])
+        }
+    return guild["role_index"]
+
+
+def get_guild_role(guild, role_id):
+    if (i := get_guild_role_index(guild).get(str(role_id))) is None:
+        return None
+    return guild["roles"][i]
+
+
+def get_member_permissions(guild, member_roles):
+    if (perm := guild.get("everyone_permissions")) is None:
+        everyone = get_guild_role(guild, guild["id"])
+        perm = everyone["permissions"] if everyone else 0
+
+    for role_id in member_roles:
+        if role := get_guild_role(guild, role_id):
+            perm |= role["permissions"]
+    return perm
+
+
+def get_guild_permissions_version(guild):
+    # stamped by the bot, computed here for older snapshots
+    if version := guild.get("permissions_version"):
+        return version
+
+    payload = json.dumps(
+        [guild["owner_id"], guild["roles"], guild["channels"]],
+        sort_keys=True,
+        separators=(",", ":"),
+    )
+    return hashlib.blake2b(payload.encode(), digest_size=16).hexdigest()
+
+
+def get_guild_permission_index(guild):
+    # also returns the ids of the members that have channel overwrites
+    version = get_guild_permissions_version(guild)
+
+    def load():
+        channels = sorted(
+            (c for c in guild["channels"] if c["type"] in ["text", "category"]),
+            key=lambda c: c["position"],
+        )
+        return {
+            "version": version,
+            "channels": {channel["id"]: channel for channel in channels},
+            "member_overwrites": frozenset(
+                overwrite["id"]
+                for channel in channels
+                for overwrite in channel["permission_overwrites"]
+                if overwrite["type"] == "member"
+            ),
+        }
+
+    return guild_permission_index_cache.get_or_load(
+        (guild["id"], version), load
+    )
+
+
+def get_channel_permission_table(guild, member_roles, user_id):
+    """Return channel id -> CHANNEL_PERMISSIONS flags for a member.
+
+    Tables are shared by every member with the same roles, unless the member
+    owns the guild or has a member overwrite, and are recomputed only when
+    the guild's permissions version changes. A `user_id` of `None` gives the
+    table of the roles alone.
+    """
+    index = get_guild_permission_index(guild)
+    member_roles = sorted({str(role) for role in member_roles})
+    user_id = None if user_id is None else str(user_id)
+    if user_id is not None and (
+        user_id == str(guild["owner_id"])
+        or user_id in index["member_overwrites"]
+    ):
+        table_user_id = user_id
+    else:
+        table_user_id = None
+
+    def load():
+        return {
+            channel_id: compute_channel_permissions(
+                channel, guild, member_roles, user_id
+            )
+            for channel_id, channel in index["channels"].items()
+        }
+
+    key = (guild["id"], index["version"], tuple(member_roles), table_user_id)
+    return channel_permission_table_cache.get_or_load(key, load)
+
+
+def get_channel_permission_tables(
+    guild_id, force_everyone=False, forced_role=0
+):
     if user_unauthenticated() or force_everyone:
         member_roles = [guild_id]  # equivalent to @everyone role
+        # guild ownership and member overwrites don't apply to @everyone
+        user_id = None
     else:
-        member_roles = get_member_roles(guild_id, session["user_id"])
+        user_id = session["user_id"]
+        member_roles = get_member_roles(guild_id, user_id)
         if guild_id not in member_roles:
             member_roles.append(guild_id)
     if forced_role:
@@ -207,110 +378,83 @@ def get_guild_channels(guild_id, force_everyone=False, forced_role=0):
         bot_member_roles.append(guild_id)
 
     if not (guild := bot_http_client.get_guild(guild_id)):
-        return []
+        return None
 
-    db_guild = (
-        db.session.query(Guilds).filter(Guilds.guild_id == guild_id).first()
+    return (
+        get_guild_permission_index(guild)["channels"],
+        get_channel_permission_table(guild, member_roles, user_id),
+        get_channel_permission_table(
+            guild, bot_member_roles, config["client-id"]
+        ),
     )
-    guild_channels = guild["channels"]
-    guild_roles = guild["roles"]
-    guild_owner = guild["owner_id"]
-    result_channels = []
-
-    for channel in guild_channels:
-        if channel["type"] in ["text", "category"]:
-            result = get_channel_permission(
-                channel,
-                guild_id,
-                guild_owner,
-                guild_roles,
-                member_roles,
-                str(session.get("user_id")),
-            )
-            bot_result = get_channel_permission(
-                channel,
-                guild_id,
-                guild_owner,
-                guild_roles,
-                bot_member_roles,
-                config["client-id"],
-            )
-            if not bot_result["read"]:
-                result["read"] = False
-            if not bot_result["write"]:
-                result["write"] = False
-            if not bot_result["mention_everyone"]:
-                result["mention_everyone"] = False
-            if (
-                not bot_result["attach_files"]
-                or not db_guild.file_upload
-                or not result["write"]
-            ):
-                result["attach_files"] = False
-            if (
-                not bot_result["embed_links"]
-                or not db_guild.send_rich_embed
-                or not result["write"]
-            ):
-                result["embed_links"] = False
-            result_channels.append(result)
-
-    return sorted(result_channels, key=lambda k: k["channel"]["position"])
-
-
-def get_channel_permission(
-    channel,
-    guild_id,
-    guild_owner,
-    guild_roles,
-    member_roles,
-    user_id=None,
+
+
+def combine_channel_permissions(channel, flags, bot_flags, db_guild):
+    # the bot has to be able to do anything the user does on its behalf
+    flags &= bot_flags
+    if not flags & WRITE or not db_guild.file_upload:
+        flags &= ~ATTACH_FILES
+    if not flags & WRITE or not db_guild.send_rich_embed:
+        flags &= ~EMBED_LINKS
+
+    result = {"channel": channel}
+    for i, (name, _) in enumerate(CHANNEL_PERMISSIONS):
+        result[name] = bool(flags & (1 << i))
+    return result
+
+
+def get_guild_channels(guild_id, force_everyone=False, forced_role=0):
+    if not (
+        tables := get_channel_permission_tables(
+            guild_id, force_everyone, forced_role
+        )
+    ):
+        return []
+
+    channels, user_table, bot_table = tables
+    db_guild = get_db_guild(guild_id)
+    return [
+        combine_channel_permissions(
+            channel, user_table[channel_id], bot_table[channel_id], db_guild
+        )
+        for channel_id, channel in channels.items()
+    ]
+
+
+def get_guild_channel(
+    guild_id, channel_id, force_everyone=False, forced_role=0
 ):
-    result = {
-        "channel": channel,
-        "read": False,
-        "write": False,
-        "mention_everyone": False,
-        "attach_files": False,
-        "embed_links": False,
-    }
-    if not user_id:
-        user_id = str(session.get("user_id"))
-    if guild_owner == user_id:
-        result["read"] = True
-        result["write"] = True
-        result["mention_everyone"] = True
-        result["attach_files"] = True
-        result["embed_links"] = True
-        return result
-    channel_perm = 0
-
-    role_positions = {str(role["id"]): role["position"] for role in guild_roles}
-    member_roles = sorted(
-        member_roles, key=lambda x: role_positions.get(str(x), -1), reverse=True
+    if not (
+        tables := get_channel_permission_tables(
+            guild_id, force_everyone, forced_role
+        )
+    ):
+        return None
+
+    channels, user_table, bot_table = tables
+    if not (channel := channels.get(str(channel_id))):
+        return None
+
+    return combine_channel_permissions(
+        channel,
+        user_table[channel["id"]],
+        bot_table[channel["id"]],
+        get_db_guild(guild_id),
     )
 
-    # @everyone
-    for role in guild_roles:
-        if role["id"] == guild_id:
-            channel_perm = role["permissions"]
-            break
 
-    # User Guild Roles
-    for m_role in member_roles:
-        for g_role in guild_roles:
-            if g_role["id"] == m_role:
-                channel_perm |= g_role["permissions"]
-                continue
+def compute_channel_permissions(channel, guild, member_roles, user_id):
+    # a user_id of None gives the flags of the roles alone
+    if user_id is not None and str(guild["owner_id"]) == str(user_id):
+        return ALL_CHANNEL_PERMISSIONS
+    guild_id = guild["id"]
+
+    # @everyone and user guild roles
+    channel_perm = get_member_permissions(guild, member_roles)
 
     # If has server administrator permission
     if user_has_permission(channel_perm, 3):
-        result["read"] = True
-        result["write"] = True
-        result["mention_everyone"] = True
-        result["attach_files"] = True
-        result["embed_links"] = True
-        return result
+        return ALL_CHANNEL_PERMISSIONS
 
     # Apply @everyone allow/deny first since it's special
     try:
@@ -337,34 +481,26 @@ def get_channel_permission(
     channel_perm = (channel_perm & ~denies) | allows
 
     # member specific
-    for overwrite in remaining_overwrites:
+    for overwrite in remaining_overwrites if user_id is not None else []:
         if overwrite["type"] == "member" and overwrite["id"] == str(user_id):
             channel_perm = (channel_perm & ~overwrite["deny"]) | overwrite[
                 "allow"
             ]
             break
 
-    result["read"] = user_has_permission(channel_perm, 10)
-    result["write"] = user_has_permission(channel_perm, 11)
-    result["mention_everyone"] = user_has_permission(channel_perm, 17)
-    result["attach_files"] = user_has_permission(channel_perm, 15)
-    result["embed_links"] = user_has_permission(channel_perm, 14)
-
     # If you cant read channel, you cant write in it
     if not user_has_permission(channel_perm, 10):
-        result["read"] = False
-        result["write"] = False
-        result["mention_everyone"] = False
-        result["attach_files"] = False
-        result["embed_links"] = False
+        return 0
 
-    return result
+    flags = 0
+    for i, (_, bit) in enumerate(CHANNEL_PERMISSIONS):
+        if user_has_permission(channel_perm, bit):
+            flags |= 1 << i
+    return flags
 
 
 def get_forced_role(guild_id):
-    db_guild = (
-        db.session.query(Guilds).filter(Guilds.guild_id == guild_id).first()
-    )
+    db_guild = get_db_guild(guild_id)
     if not session.get("unauthenticated", True):
         return db_guild.autorole_discord
 
@@ -372,20 +508,9 @@ def get_forced_role(guild_id):
 
 
 def bot_can_create_webhooks(guild):
-    perm = 0
-
-    # @everyone
-    for role in guild["roles"]:
-        if role["id"] == guild["id"]:
-            perm |= role["permissions"]
-            continue
-
-    # User Guild Roles
-    for m_role in get_member_roles(guild["id"], config["client-id"]):
-        for g_role in guild["roles"]:
-            if g_role["id"] == m_role:
-                perm |= g_role["permissions"]
-                continue
+    perm = get_member_permissions(
+        guild, get_member_roles(guild["id"], config["client-id"])
+    )
 
     if user_has_permission(perm, 3):  # Admin perms override yes
         return True
@@ -394,9 +519,7 @@ def bot_can_create_webhooks(guild):
 
 
 def guild_webhooks_enabled(guild_id):
-    db_guild = (
-        db.session.query(Guilds).filter(Guilds.guild_id == guild_id).first()
-    )
+    db_guild = get_db_guild(guild_id)
     if not db_guild.webhook_messages:
         return False
 
@@ -404,9 +527,7 @@ def guild_webhooks_enabled(guild_id):
 
 
 def guild_unauthcaptcha_enabled(guild_id):
-    db_guild = (
-        db.session.query(Guilds).filter(Guilds.guild_id == guild_id).first()
-    )
+    db_guild = get_db_guild(guild_id)
     return db_guild.unauth_captcha
 
 